@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 from torch.utils.model_zoo import load_url as load_state_dict_from_url
 
@@ -74,10 +75,12 @@ class InvertedResidual(nn.Module):
             nn.BatchNorm2d(oup),
         ])
         self.conv = nn.Sequential(*layers)
+        # the residual addition as a module, so it can be observed and quantized
+        self.skip_add = nn.quantized.FloatFunctional()
 
     def forward(self, x):
         if self.use_res_connect:
-            return x + self.conv(x)
+            return self.skip_add.add(x, self.conv(x))
         else:
             return self.conv(x)
 
@@ -144,6 +147,11 @@ class MobileNetV2(nn.Module):
         # make it nn.Sequential
         self.features = nn.Sequential(*features)
 
+        # features[:frozen_prefix] are frozen (see train/backbone_freezer.py), they are run without
+        # recording the autograd graph, and with batch norm in eval mode if frozen_bn_eval
+        self.frozen_prefix = 0
+        self.frozen_bn_eval = False
+
         # weight initialization
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -158,7 +166,17 @@ class MobileNetV2(nn.Module):
                 nn.init.zeros_(m.bias)
 
     def _forward(self, x):
-        for idx, layer in enumerate(self.features):
+        inter = None
+        frozen = min(self.frozen_prefix, len(self.features))
+        if frozen > 0:
+            # no backward goes through the frozen layers, so their activations need not be kept
+            with torch.no_grad():
+                inter, x = self._forward_features(x, inter, 0, frozen)
+        return self._forward_features(x, inter, frozen, len(self.features))
+
+    def _forward_features(self, x, inter, start, end):
+        for idx in range(start, end):
+            layer = self.features[idx]
             # want to get expansion of layer 15
             if idx == 14:
                 res_connect = x
@@ -170,7 +188,7 @@ class MobileNetV2(nn.Module):
                         if i == 0:
                             inter = x
                 if layer.use_res_connect:
-                    x += res_connect
+                    x = layer.skip_add.add(x, res_connect)
             else:
                 x = layer(x)
         return inter, x
@@ -178,6 +196,14 @@ class MobileNetV2(nn.Module):
     # Allow for accessing forward method in a inherited class
     forward = _forward
 
+    def train(self, mode=True):
+        super(MobileNetV2, self).train(mode)
+        if mode and self.frozen_bn_eval:
+            # frozen layers keep their batch norm statistics
+            for layer in self.features[:self.frozen_prefix]:
+                layer.eval()
+        return self
+
 
 def mobilenet_v2(pretrained=True, progress=True, **kwargs):
     """
@@ -0,0 +1,89 @@
+import torch
+import torch.nn as nn
+
+from general_config import constants
+
+"""
+Box decoding, class scores and top-K selection as torch modules, so that exported graphs
+(TorchScript, ONNX) do the whole detection job except the NMS in a single call
+
+Same computations as Model_output_handler (scale_xy = 10, scale_wh = 5, softmax without the
+background column or sigmoid), with fixed size outputs
+"""
+
+
+class DetectionPostprocess(nn.Module):
+    """
+    Arguments:
+    anchors_xywh - #anchors x 4 default boxes, kept as a buffer
+    loss_type - softmax or BCE, picks the score activation
+    anchor_major - layout of the model outputs, see params.anchor_major
+    top_k - number of detections kept per image, sorted decreasingly by score
+
+    forward(locs, confs) returns, for each image:
+    boxes - B x top_k x 4, (x1, y1, x2, y2) relative to the image size
+    scores - B x top_k, confidence of the predicted class
+    class_ids - B x top_k, index of the predicted class (background excluded)
+    """
+
+    def __init__(self, anchors_xywh, loss_type, anchor_major=False, top_k=200, scale_xy=10, scale_wh=5):
+        super().__init__()
+        self.register_buffer('anchors_xywh', anchors_xywh)
+        self.use_sigmoid = loss_type == constants.BCE_loss
+        self.anchor_major = anchor_major
+        self.top_k = min(top_k, anchors_xywh.shape[0])
+        self.scale_xy = scale_xy
+        self.scale_wh = scale_wh
+
+    def decode(self, locs, confs):
+        """
+        boxes B x #anchors x 4 as (x center, y center, width, height) and scores B x #anchors x #classes
+        """
+        if not self.anchor_major:
+            locs, confs = locs.permute(0, 2, 1), confs.permute(0, 2, 1)
+
+        xy = locs[..., :2] / self.scale_xy * self.anchors_xywh[:, 2:] + self.anchors_xywh[:, :2]
+        wh = (locs[..., 2:] / self.scale_wh).exp() * self.anchors_xywh[:, 2:]
+        boxes = torch.cat([xy, wh], dim=2)
+
+        if self.use_sigmoid:
+            scores = confs.sigmoid()
+        else:
+            # cut the background column
+            scores = torch.softmax(confs, dim=2)[..., :-1]
+        return boxes, scores
+
+    def forward(self, locs, confs):
+        boxes, scores = self.decode(locs, confs)
+        best_scores, class_ids = scores.max(dim=2)
+        top_scores, top_indices = best_scores.topk(self.top_k, dim=1)
+
+        top_boxes = boxes.gather(1, top_indices.unsqueeze(-1).expand(-1, -1, 4))
+        top_boxes = torch.cat([top_boxes[..., :2] - top_boxes[..., 2:] / 2,
+                               top_boxes[..., :2] + top_boxes[..., 2:] / 2], dim=2)
+        return top_boxes, top_scores, class_ids.gather(1, top_indices)
+
+
+class Deploy_Detector(nn.Module):
+    """
+    SSD_Head / SSD300 followed by DetectionPostprocess: images in, top_k detections out
+    """
+
+    def __init__(self, model, postprocess):
+        super().__init__()
+        self.model = model
+        self.postprocess = postprocess
+
+    def forward(self, images):
+        locs, confs = self.model(images)
+        return self.postprocess(locs, confs)
+
+
+def with_postprocess(model, anchors_xywh, params, top_k=200):
+    """
+    appends the postprocessing to model, the anchors must be the ones of the model_id of model
+    """
+    device = next(model.parameters()).device
+    postprocess = DetectionPostprocess(anchors_xywh.to(device), params.loss_type,
+                                       anchor_major=model.anchor_major, top_k=top_k)
+    return Deploy_Detector(model, postprocess)
@@ -0,0 +1,220 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from architectures.models.SSDLite import DepthWiseConv_No_ReLu
+
+"""
+Inference time batch norm folding, for all the models (SSD_Head with its MobileNetV2 backbone and
+SSD300 with its ResNet backbone)
+
+In eval mode a batch norm is an affine transform per channel: y = a * x + b, with
+a = gamma / sqrt(running_var + eps) and b = beta - running_mean * a
+- conv -> bn: folded back into the conv, W' = a * W, bias' = a * bias + b
+- bn -> 1x1 conv (DepthWiseConv_No_ReLu: ds_bn -> pw_conv): folded forward into the conv,
+W' = W * a (over input channels), bias' = bias + W @ b. This is only valid because the 1x1 conv
+has no padding, a padded conv would see zeros instead of b at the borders
+The folded batch norms are replaced by identities, so the module structure (and the forward code)
+stays the same
+
+fuse_heads additionally merges the loc and conf heads of each feature map into a single conv (chain),
+see Fused_Heads
+"""
+
+
+def fold_bn_into_next_conv(bn, conv):
+    """
+    returns a copy of the 1x1 conv that follows bn, with bn folded in
+    """
+    assert conv.kernel_size == (1, 1) and conv.padding == (0, 0) and conv.groups == 1, \
+        "batch norm can only be folded forward into an unpadded 1x1 conv"
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+
+    fused = copy.deepcopy(conv)
+    weight = conv.weight.view(conv.out_channels, conv.in_channels)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(conv.weight[:, 0, 0, 0])
+    fused.weight = nn.Parameter((weight * scale).view_as(conv.weight))
+    fused.bias = nn.Parameter(bias + weight @ shift)
+    return fused
+
+
+def _fuse_sequential(sequential):
+    """
+    folds every conv -> bn pair of consecutive modules
+    """
+    for idx in range(len(sequential) - 1):
+        conv, bn = sequential[idx], sequential[idx + 1]
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            sequential[idx] = fuse_conv_bn_eval(conv, bn)
+            sequential[idx + 1] = nn.Identity()
+
+
+def _fuse_named_pairs(module):
+    """
+    folds the convK -> bnK attribute pairs of the torchvision resnet blocks
+    """
+    for name, child in list(module.named_children()):
+        if not (name.startswith('bn') and isinstance(child, nn.BatchNorm2d)):
+            continue
+        conv = getattr(module, 'conv' + name[2:], None)
+        if isinstance(conv, nn.Conv2d):
+            setattr(module, 'conv' + name[2:], fuse_conv_bn_eval(conv, child))
+            setattr(module, name, nn.Identity())
+
+
+def fuse_for_inference(model, inplace=False):
+    """
+    returns model (a copy, unless inplace) in eval mode with all its batch norms folded into convolutions
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+
+    with torch.no_grad():
+        for module in list(model.modules()):
+            if isinstance(module, DepthWiseConv_No_ReLu):
+                module.pw_conv = fold_bn_into_next_conv(module.ds_bn, module.pw_conv)
+                module.ds_bn = nn.Identity()
+            elif isinstance(module, nn.Sequential):
+                _fuse_sequential(module)
+            else:
+                _fuse_named_pairs(module)
+    return model
+
+
+def check_fusion(model, fused_model, params, device, batch_size=2, rtol=1e-3, atol=1e-4):
+    """
+    numerical equivalence check of the fused model against the original one on random images
+    raises if any output differs more than the tolerance, returns the max absolute differences
+    """
+    model.eval()
+    images = torch.randn(batch_size, 3, params.input_height, params.input_width, device=device)
+    with torch.no_grad():
+        expected, actual = model(images), fused_model(images)
+
+    differences = []
+    for e, a in zip(expected, actual):
+        differences.append((e - a).abs().max().item())
+        if not torch.allclose(e, a, rtol=rtol, atol=atol):
+            raise RuntimeError("Fused model differs from the original one, max abs difference: {}".format(
+                differences[-1]))
+    return differences
+
+
+def merge_convs(convs):
+    """
+    one conv computing the concatenated outputs of convs, which all see the same input
+    with the same kernel size, stride and padding
+    """
+    first = convs[0]
+    merged = nn.Conv2d(first.in_channels, sum(conv.out_channels for conv in convs), first.kernel_size,
+                       stride=first.stride, padding=first.padding, groups=first.groups, bias=True)
+    merged.weight.data = torch.cat([conv.weight for conv in convs], dim=0)
+    merged.bias.data = torch.cat([conv.bias if conv.bias is not None else
+                                  torch.zeros_like(conv.weight[:, 0, 0, 0]) for conv in convs])
+    return merged.to(first.weight.device)
+
+
+def merge_depthwise_heads(loc, conf):
+    """
+    merges two DepthWiseConv_No_ReLu heads that see the same input:
+    - the two depth wise convs become one with 2 outputs per input channel, interleaved
+    (channel 2c is the loc one, 2c + 1 the conf one)
+    - the two point wise convs become one dense 1x1 conv over the interleaved channels, with a block
+    structure: the loc outputs only read the even channels, the conf outputs only the odd ones
+
+    the zero blocks double the multiply-adds of the point wise part, this is traded for half the
+    kernel launches: only a win where the launches dominate (small maps, fast devices), on cpu the
+    large first map (19x19x576 for SSDLite) can make it slower, measure it with
+    custom_inference/profile_benchmark.py before turning on general_config.fuse_heads
+    """
+    # batch norms go into the point wise convs first
+    loc_pw, conf_pw = loc.pw_conv, conf.pw_conv
+    if isinstance(loc.ds_bn, nn.BatchNorm2d):
+        loc_pw = fold_bn_into_next_conv(loc.ds_bn, loc_pw)
+    if isinstance(conf.ds_bn, nn.BatchNorm2d):
+        conf_pw = fold_bn_into_next_conv(conf.ds_bn, conf_pw)
+
+    channels = loc.ds_conv.in_channels
+    ds_conv = nn.Conv2d(channels, 2 * channels, loc.ds_conv.kernel_size, stride=loc.ds_conv.stride,
+                        padding=loc.ds_conv.padding, groups=channels, bias=True)
+    ds_conv.weight.data[0::2] = loc.ds_conv.weight
+    ds_conv.weight.data[1::2] = conf.ds_conv.weight
+    ds_conv.bias.data[0::2] = loc.ds_conv.bias
+    ds_conv.bias.data[1::2] = conf.ds_conv.bias
+
+    n_loc, n_conf = loc_pw.out_channels, conf_pw.out_channels
+    pw_conv = nn.Conv2d(2 * channels, n_loc + n_conf, kernel_size=1, bias=True)
+    pw_conv.weight.data.zero_()
+    pw_conv.weight.data[:n_loc, 0::2] = loc_pw.weight
+    pw_conv.weight.data[n_loc:, 1::2] = conf_pw.weight
+    pw_conv.bias.data = torch.cat([loc_pw.bias, conf_pw.bias])
+
+    return nn.Sequential(ds_conv, pw_conv).to(loc.pw_conv.weight.device)
+
+
+class Fused_Heads(nn.Module):
+    """
+    loc and conf predictions with one head per feature map, drop in replacement of bbox_view
+    the head outputs are written directly in the final locs B x 4 x #anchors and confs
+    B x #classes x #anchors tensors (B x #anchors x 4 and B x #anchors x #classes if anchor_major),
+    instead of going through 12 views and 2 concatenations
+    """
+
+    def __init__(self, heads, num_defaults, label_num, anchor_major=False):
+        super().__init__()
+        self.heads = nn.ModuleList(heads)
+        self.num_defaults = num_defaults
+        self.label_num = label_num
+        self.anchor_major = anchor_major
+
+    def forward(self, src):
+        outputs = [head(s) for s, head in zip(src, self.heads)]
+        batch_size = outputs[0].size(0)
+        n_anchors = sum(nd * out.size(2) * out.size(3) for nd, out in zip(self.num_defaults, outputs))
+
+        if self.anchor_major:
+            locs = outputs[0].new_empty(batch_size, n_anchors, 4)
+            confs = outputs[0].new_empty(batch_size, n_anchors, self.label_num)
+        else:
+            locs = outputs[0].new_empty(batch_size, 4, n_anchors)
+            confs = outputs[0].new_empty(batch_size, self.label_num, n_anchors)
+
+        offset = 0
+        for nd, out in zip(self.num_defaults, outputs):
+            height, width = out.size(2), out.size(3)
+            n = nd * height * width
+            # same element order as out[:, :4 * nd].view(batch_size, 4, -1) in bbox_view
+            out_locs = out[:, :4 * nd].view(batch_size, 4, nd, height, width)
+            out_confs = out[:, 4 * nd:].view(batch_size, self.label_num, nd, height, width)
+            if self.anchor_major:
+                locs[:, offset:offset + n].view(batch_size, nd, height, width, 4).copy_(
+                    out_locs.permute(0, 2, 3, 4, 1))
+                confs[:, offset:offset + n].view(batch_size, nd, height, width, self.label_num).copy_(
+                    out_confs.permute(0, 2, 3, 4, 1))
+            else:
+                locs[:, :, offset:offset + n].view(batch_size, 4, nd, height, width).copy_(out_locs)
+                confs[:, :, offset:offset + n].view(
+                    batch_size, self.label_num, nd, height, width).copy_(out_confs)
+            offset += n
+        return locs, confs
+
+
+def fuse_heads(model):
+    """
+    sets model.fused_heads, in place, used by bbox_view instead of the separate loc and conf heads
+    (which are kept, so the state dict is unchanged), works for SSD_Head and SSD300 in eval mode
+    """
+    model.eval()
+    with torch.no_grad():
+        heads = []
+        for loc, conf in zip(model.loc, model.conf):
+            if isinstance(loc, DepthWiseConv_No_ReLu):
+                heads.append(merge_depthwise_heads(loc, conf))
+            else:
+                heads.append(merge_convs([loc, conf]))
+    model.fused_heads = Fused_Heads(heads, list(model.num_defaults), model.label_num,
+                                    model.anchor_major)
+    return model
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.quantization import QuantStub, DeQuantStub
 
 from architectures.backbones.MobileNet import ConvBNReLU, mobilenet_v2
 
@@ -39,7 +40,11 @@ class DepthWiseConv(nn.Module):
 
 class SSD_Head(nn.Module):
     def __init__(self, n_classes=81, k_list=[4, 6, 6, 6, 6, 6],
-                 out_channels=[576, 1280, 512, 256, 256, 128], width_mult=1):
+                 out_channels=[576, 1280, 512, 256, 256, 128], width_mult=1, anchor_major=False):
+        """
+        anchor_major - output locs B x #anchors x 4 and confs B x #anchors x n_classes instead of
+        B x 4 x #anchors and B x n_classes x #anchors
+        """
         super().__init__()
         self.backbone = mobilenet_v2(pretrained=True, width_mult=width_mult, num_classes=n_classes)
         self.out_channels = out_channels
@@ -58,6 +63,14 @@ class SSD_Head(nn.Module):
         self.loc = nn.ModuleList(self.loc)
         self.conf = nn.ModuleList(self.conf)
         self._init_weights()
+        self.anchor_major = anchor_major
+        # inference only, see architectures/fusion.fuse_heads
+        self.fused_heads = None
+
+        # identities in float, mark where the int8 part of the model starts and ends once
+        # quantized (see architectures/quantization.py)
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
 
     def _build_additional_features(self, input_sizes):
         self.additional_blocks = []
@@ -80,16 +93,32 @@ class SSD_Head(nn.Module):
 
     # Shape the classifier to the view of bboxes
     def bbox_view(self, src, loc, conf):
+        if self.fused_heads is not None:
+            return self.fused_heads(src)
         ret = []
         for s, l, c in zip(src, loc, conf):
-            ret.append((l(s).view(s.size(0), 4, -1), c(s).view(s.size(0), self.label_num, -1)))
+            # reshape, not view: the head outputs are not contiguous for channels_last models
+            ret.append((self.dequant(l(s)).reshape(s.size(0), 4, -1),
+                        self.dequant(c(s)).reshape(s.size(0), self.label_num, -1)))
 
         locs, confs = list(zip(*ret))
+        if self.anchor_major:
+            # the transposition is done by the concatenation copy, which is made anyway
+            locs = torch.cat([l.permute(0, 2, 1) for l in locs], 1)
+            confs = torch.cat([c.permute(0, 2, 1) for c in confs], 1)
+            return locs, confs
         locs, confs = torch.cat(locs, 2).contiguous(), torch.cat(confs, 2).contiguous()
         return locs, confs
 
     def forward(self, x):
-        inter_layer, x = self.backbone(x)
+        inter_layer, x = self.backbone(self.quant(x))
+        return self.head_forward(inter_layer, x)
+
+    def head_forward(self, inter_layer, x):
+        """
+        everything after the backbone, starting from its two output feature maps
+        also used to train the heads on cached backbone features, see train/feature_cache.py
+        """
         detection_feed = [inter_layer, x]
         for l in self.additional_blocks:
             x = l(x)
@@ -40,7 +40,11 @@ class ResNet(nn.Module):
 
 
 class SSD300(nn.Module):
-    def __init__(self, backbone=ResNet('resnet50'), n_classes=81):
+    def __init__(self, backbone=ResNet('resnet50'), n_classes=81, anchor_major=False):
+        """
+        anchor_major - output locs B x #anchors x 4 and confs B x #anchors x n_classes instead of
+        B x 4 x #anchors and B x n_classes x #anchors
+        """
         super().__init__()
 
         self.backbone = backbone
@@ -58,6 +62,9 @@ class SSD300(nn.Module):
         self.loc = nn.ModuleList(self.loc)
         self.conf = nn.ModuleList(self.conf)
         self._init_weights()
+        self.anchor_major = anchor_major
+        # inference only, see architectures/fusion.fuse_heads
+        self.fused_heads = None
 
     def _build_additional_features(self, input_size):
         self.additional_blocks = []
@@ -95,11 +102,19 @@ class SSD300(nn.Module):
 
     # Shape the classifier to the view of bboxes
     def bbox_view(self, src, loc, conf):
+        if self.fused_heads is not None:
+            return self.fused_heads(src)
         ret = []
         for s, l, c in zip(src, loc, conf):
-            ret.append((l(s).view(s.size(0), 4, -1), c(s).view(s.size(0), self.label_num, -1)))
+            # reshape, not view: the head outputs are not contiguous for channels_last models
+            ret.append((l(s).reshape(s.size(0), 4, -1), c(s).reshape(s.size(0), self.label_num, -1)))
 
         locs, confs = list(zip(*ret))
+        if self.anchor_major:
+            # the transposition is done by the concatenation copy, which is made anyway
+            locs = torch.cat([l.permute(0, 2, 1) for l in locs], 1)
+            confs = torch.cat([c.permute(0, 2, 1) for c in confs], 1)
+            return locs, confs
         locs, confs = torch.cat(locs, 2).contiguous(), torch.cat(confs, 2).contiguous()
         return locs, confs
 
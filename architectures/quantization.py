@@ -0,0 +1,163 @@
+import copy
+import torch
+from torch.nn.intrinsic.qat import freeze_bn_stats
+from torch.quantization import fuse_modules, get_default_qconfig, get_default_qat_qconfig, prepare, \
+    prepare_qat, convert, disable_observer, FakeQuantize
+from torch.ao.quantization import fuse_modules_qat
+
+from architectures.backbones.MobileNet import ConvBNReLU, InvertedResidual
+from architectures.models.SSDLite import DepthWiseConv_No_ReLu
+from general_config import general_config, constants
+
+"""
+Post training static int8 quantization and quantization aware training of SSD_Head
+(eager mode torch.quantization)
+
+The float model already contains everything needed: QuantStub / DeQuantStub around SSD_Head and
+FloatFunctional residual additions in MobileNetV2. The post training pipeline is:
+fuse conv + batch norm -> insert observers -> calibrate on validation images -> convert to int8
+Quantization aware training instead fuses and inserts fake quantization modules for the last
+params.qat_epochs epochs of train.train, see qat_step
+
+ReLU6 is kept as a separate (quantized) module, fusing it would mean replacing it by ReLU
+The quantized model only runs on cpu
+"""
+
+
+def fuse_model(model, qat=False):
+    """
+    folds the batch norms of SSD_Head into the preceding convolutions, in place, model must be in eval mode
+    qat - model in train mode, conv + bn pairs become ConvBn2d modules that keep the batch norm
+    (and its parameters) instead of folding it
+    """
+    fuse = fuse_modules_qat if qat else fuse_modules
+    # the module list is collected first, fusing replaces submodules
+    for module in list(model.modules()):
+        if isinstance(module, ConvBNReLU):
+            fuse(module, ['0', '1'], inplace=True)
+        elif isinstance(module, InvertedResidual):
+            # the linear pw conv + bn closing the block, the other ones are ConvBNReLU
+            n_layers = len(module.conv)
+            fuse(module.conv, [str(n_layers - 2), str(n_layers - 1)], inplace=True)
+        elif isinstance(module, DepthWiseConv_No_ReLu):
+            fuse(module, ['ds_conv', 'ds_bn'], inplace=True)
+    return model
+
+
+def calibrate(model, data_loader, n_images=300):
+    """
+    runs the observed model over the first n_images of data_loader to collect activation ranges
+    """
+    seen = 0
+    with torch.no_grad():
+        for input_, _, _ in data_loader:
+            model(input_.cpu())
+            seen += input_.shape[0]
+            if seen >= n_images:
+                break
+    print("Calibrated on {} images".format(seen))
+
+
+def quantize_static(model, calibration_loader, n_images=300, engine=None):
+    """
+    returns an int8 copy of the float model, the given model is left untouched
+    """
+    engine = engine or general_config.quantized_engine
+    torch.backends.quantized.engine = engine
+
+    quantized_model = copy.deepcopy(model).cpu().eval()
+    # no frozen prefix bookkeeping at inference time
+    if hasattr(quantized_model.backbone, 'frozen_prefix'):
+        quantized_model.backbone.frozen_prefix = 0
+    fuse_model(quantized_model)
+
+    quantized_model.qconfig = get_default_qconfig(engine)
+    prepare(quantized_model, inplace=True)
+    calibrate(quantized_model, calibration_loader, n_images)
+    convert(quantized_model, inplace=True)
+    return quantized_model
+
+
+def save_quantized(quantized_model, params, path):
+    """
+    saves the int8 model as TorchScript, so it can be loaded without re-running the pipeline
+    (see the int8 backend of custom_inference/backends.py)
+    """
+    example = torch.randn(1, 3, params.input_height, params.input_width)
+    with torch.no_grad():
+        scripted = torch.jit.trace(quantized_model, example)
+    torch.jit.save(scripted, str(path))
+    print("Saved int8 model to {}".format(path))
+
+
+def model_size(model):
+    """
+    size in MB of the saved state dict, int8 weights take a quarter of the fp32 ones
+    """
+    n_bytes = 0
+    for value in model.state_dict().values():
+        if isinstance(value, torch.Tensor):
+            n_bytes += value.numel() * value.element_size()
+    return n_bytes / 2**20
+
+
+def prepare_qat_model(model, engine=None):
+    """
+    fuses model and inserts fake quantization modules, in place
+    the parameters stay the same objects, so the optimizer keeps working on them
+    """
+    engine = engine or general_config.quantized_engine
+    torch.backends.quantized.engine = engine
+    device = next(model.parameters()).device
+
+    # fuse everything in train mode (conv + bn kept separate, as ConvBn2d): in eval mode the batch
+    # norms would be folded into new weight tensors, unknown to the optimizer
+    for module in model.modules():
+        module.training = True
+    fuse_model(model, qat=True)
+
+    model.qconfig = get_default_qat_qconfig(engine)
+    prepare_qat(model, inplace=True)
+    # the observers are created on cpu, the frozen layers go back to their eval mode
+    model.to(device)
+    model.train()
+    return model
+
+
+def has_fake_quant(model):
+    return any(isinstance(module, FakeQuantize) for module in model.modules())
+
+
+def qat_step(epoch, model, params):
+    """
+    called at the start of every training epoch, returns True while quantization aware training is on
+    the model is prepared when the last params.qat_epochs epochs start, then, counting from there,
+    the batch norm statistics are frozen after params.qat_freeze_bn_after epochs and the
+    quantization ranges after params.qat_freeze_observers_after epochs
+    """
+    if not params.qat_epochs:
+        return False
+    qat_epoch = epoch - (params.n_epochs - params.qat_epochs)
+    if qat_epoch < 0:
+        return False
+
+    if not has_fake_quant(model):
+        if general_config.model_id == constants.ssd:
+            raise ValueError("Quantization aware training is only supported for the SSDLite models")
+        print("Starting quantization aware training")
+        prepare_qat_model(model)
+
+    if qat_epoch >= params.qat_freeze_bn_after:
+        model.apply(freeze_bn_stats)
+    if qat_epoch >= params.qat_freeze_observers_after:
+        model.apply(disable_observer)
+    return True
+
+
+def convert_qat_model(model):
+    """
+    returns the int8 cpu copy of a model trained with fake quantization
+    """
+    quantized_model = copy.deepcopy(model).cpu().eval()
+    convert(quantized_model, inplace=True)
+    return quantized_model
@@ -3,11 +3,11 @@ import torch
 from train.params import Params
 from general_config import constants, general_config
 from train.validate import Model_evaluator
-from benchmarks import train_benchmark, inference_benchmark
+from benchmarks import train_benchmark, inference_benchmark, optimizer_benchmark
 from data import dataloaders
 from train.optimizer_handler import plain_adam
 from train.loss_fn import Detection_Loss
-from utils.training import model_setup
+from utils.training import model_setup, optimizer_setup
 
 try:
     from apex import amp
@@ -18,10 +18,13 @@ except ModuleNotFoundError:
 APEX_AVAILABLE = True
 
 
-def run_training(benchmark_train=False, benchmark_inference=False, verbose=False, mixed_precision=False):
+def run_training(benchmark_train=False, benchmark_inference=False, verbose=False, mixed_precision=False,
+                 benchmark_optimizer=False, benchmark_compile=False):
     params = Params(constants.params_path.format(general_config.model_id))
 
     model = model_setup(params)
+    if benchmark_optimizer:
+        optimizer_benchmark.compare(model, optimizer_setup(model, params), params)
     optimizer = plain_adam(model, params)
 
     if APEX_AVAILABLE and mixed_precision:
@@ -33,6 +36,8 @@ def run_training(benchmark_train=False, benchmark_inference=False, verbose=False
 
     detection_loss = Detection_Loss(params)
 
+    if benchmark_compile:
+        train_benchmark.compare_compiled(model, optimizer, train_loader, detection_loss, params)
     if benchmark_train:
         model_evaluator = None
         train_benchmark.train(model, optimizer, train_loader, model_evaluator,
@@ -0,0 +1,67 @@
+import time
+import torch
+
+from general_config.general_config import device
+from train.lr_policies.poly_lr import Poly_LR
+
+
+def per_tensor_groups(optimizer):
+    """
+    the previous zero_wdcay_bn_bias layout, one param group for each tensor, updated by the
+    per tensor (for loop) implementation - kept only for comparison
+    """
+    new_optim = []
+    for pg in optimizer.param_groups:
+        for param in pg['params']:
+            new_group = {k: v for k, v in pg.items() if k not in ('params', 'foreach', 'fused')}
+            new_group['params'] = param
+            if len(param.shape) == 1:
+                new_group['weight_decay'] = 0
+            new_optim.append(new_group)
+
+    options = {'foreach': False} if 'foreach' in optimizer.defaults else {}
+    return type(optimizer)(new_optim, **options)
+
+
+def time_steps(model, optimizer, params, n_steps=50, warm_up=5):
+    """
+    average time of an optimizer step followed by a poly lr update, gradients are random
+    """
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) if p.requires_grad else None
+
+    lr_policy = Poly_LR(loader_size=n_steps + warm_up, optimizer=optimizer, params=params)
+    total = 0
+    for step in range(n_steps + warm_up):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.time()
+        lr_policy.step(0)
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        if step >= warm_up:
+            total += time.time() - start
+    return total / n_steps
+
+
+def compare(model, optimizer, params, n_steps=50):
+    """
+    step time of the grouped, multi tensor optimizer vs the one param group per tensor layout
+    the model weights are restored afterwards
+    """
+    initial_state = {k: v.clone() for k, v in model.state_dict().items()}
+    legacy = per_tensor_groups(optimizer)
+
+    legacy_time = time_steps(model, legacy, params, n_steps)
+    model.load_state_dict(initial_state)
+    grouped_time = time_steps(model, optimizer, params, n_steps)
+    model.load_state_dict(initial_state)
+    model.zero_grad()
+
+    print("Per tensor param groups: {} groups, {:.2f} ms/step".format(
+        len(legacy.param_groups), legacy_time * 1000))
+    print("Grouped multi tensor: {} groups, {:.2f} ms/step".format(
+        len(optimizer.param_groups), grouped_time * 1000))
+    print("Speedup: {:.2f}x".format(legacy_time / grouped_time))
+    return legacy_time, grouped_time
@@ -1,5 +1,7 @@
+import torch
 from recordtype import recordtype
 from general_config.general_config import device
+from train.compiled_step import Loss_Step
 
 import time
 
@@ -116,7 +118,66 @@ def train(model, optimizer, train_loader, model_evaluator, detection_loss, param
     print("Times on {} batches of size {}:".format(counted_batches, params.batch_size))
     print(average)
     print(total)
-    print("Total time: ", total.inference_time + total.backprop_time + total.optimizer_time)
+    total_step_time = total.inference_time + total.backprop_time + total.optimizer_time
+    print("Total time: ", total_step_time)
+    print("Steps/sec: {:.2f}".format(counted_batches / total_step_time))
+
+
+def time_steps(step_fn, model, optimizer, train_loader, n_steps, warm_up):
+    """
+    returns the steps/sec of step_fn(input_, label) -> (l_loss, c_loss) + backward + optimizer step
+    and the time taken by the warm up steps (which include the compilation)
+    """
+    model.train()
+    loader_iter = iter(train_loader)
+    timed_steps, warm_up_time, start = 0, 0, time.time()
+    for step in range(warm_up + n_steps):
+        if step == warm_up:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            warm_up_time, start = time.time() - start, time.time()
+        try:
+            input_, label, _ = next(loader_iter)
+        except StopIteration:
+            loader_iter = iter(train_loader)
+            input_, label, _ = next(loader_iter)
+
+        input_ = input_.to(device)
+        label = [label[0].to(device), label[1].to(device)]
+        optimizer.zero_grad()
+        l_loss, c_loss = step_fn(input_, label)
+        (l_loss + c_loss).backward()
+        optimizer.step()
+        timed_steps += step >= warm_up
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return timed_steps / (time.time() - start), warm_up_time
+
+
+def compare_compiled(model, optimizer, train_loader, detection_loss, params, n_steps=20, warm_up=3):
+    """
+    steps/sec of the eager train step vs the compiled forward + loss step (train/compiled_step.py),
+    both with static and dynamic batch size
+    the model keeps training during the comparison, so this should not run on a checkpoint to keep
+    """
+    def eager_step(input_, label):
+        return detection_loss.ssd_loss(model(input_), label)
+
+    results = {'eager': time_steps(eager_step, model, optimizer, train_loader, n_steps, warm_up)}
+    compile_dynamic = params.compile_dynamic
+    for dynamic in (0, 1):
+        params.compile_dynamic = dynamic
+        loss_step = Loss_Step(model, detection_loss, params)
+        name = 'compiled dynamic' if dynamic else 'compiled static'
+        results[name] = time_steps(loss_step, model, optimizer, train_loader, n_steps, warm_up)
+    params.compile_dynamic = compile_dynamic
+
+    print("Train step comparison on {} steps of batch size {}:".format(n_steps, params.batch_size))
+    for name, (steps_per_sec, warm_up_time) in results.items():
+        print("{:<18} steps/sec: {:.2f}, warm up time: {:.2f}s ({:.2f}x eager)".format(
+            name, steps_per_sec, warm_up_time, steps_per_sec / results['eager'][0]))
+    return results
 
 
 def update_losses(losses, l_loss, c_loss):
@@ -0,0 +1,167 @@
+import os
+import torch
+import cv2
+import numpy as np
+
+from custom_inference.export import export_onnx
+from custom_inference.execution_profile import Execution_Profile
+from general_config import constants, general_config
+
+try:
+    import onnxruntime
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+
+"""
+Execution backends of Custom_Infernce
+
+Every backend is called on a B x C x H x W normalized image tensor and returns the raw model
+outputs as torch tensors: locs B x 4 x #anchors and confs B x #classes x #anchors, so the
+postprocessing is shared by all of them
+- torch - pytorch model, run with an Execution_Profile (channels_last, inference_mode, bf16),
+optionally compiled (general_config.compile_inference)
+- onnxruntime - ONNX export of the model, run by ONNX Runtime (optional dependency)
+- opencv - the same ONNX export, run by cv2.dnn
+- int8 - the TorchScript model saved by the post training quantization, see custom_inference/quantize.py
+"""
+
+TORCH = "torch"
+ONNXRUNTIME = "onnxruntime"
+OPENCV = "opencv"
+INT8 = "int8"
+
+
+class Torch_Backend():
+    def __init__(self, model, device, profile=None, compile_model=False):
+        """
+        compile_model - run the model through torch.compile, the batch dimension is dynamic
+        """
+        self.model = model
+        self.device = device
+        self.profile = profile or Execution_Profile(inference_mode=False)
+        if compile_model and not hasattr(torch, 'compile'):
+            raise ValueError("general_config.compile_inference needs torch.compile (pytorch >= 2.0)")
+        self.profile.prepare_model(self.model)
+        self.forward = torch.compile(self.model, dynamic=True) if compile_model else self.model
+
+    def to(self, device):
+        self.device = device
+        self.model.to(device)
+
+    def __call__(self, images):
+        return self.profile.run(self.forward, images.to(self.device))
+
+
+class Onnxruntime_Backend():
+    def __init__(self, onnx_path, n_threads=None):
+        if not ONNXRUNTIME_AVAILABLE:
+            raise ImportError("Please install onnxruntime to use the onnxruntime backend")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = torch.device("cpu")
+
+    def to(self, device):
+        # only runs on cpu
+        pass
+
+    def __call__(self, images):
+        locs, confs = self.session.run(None, {self.input_name: images.cpu().numpy()})
+        return torch.from_numpy(locs), torch.from_numpy(confs)
+
+
+class Opencv_Backend():
+    def __init__(self, onnx_path):
+        self.net = cv2.dnn.readNetFromONNX(str(onnx_path))
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.output_names = ['locs', 'confs']
+        self.device = torch.device("cpu")
+
+    def to(self, device):
+        # only runs on cpu
+        pass
+
+    def __call__(self, images):
+        self.net.setInput(np.ascontiguousarray(images.cpu().numpy()))
+        locs, confs = self.net.forward(self.output_names)
+        return torch.from_numpy(locs), torch.from_numpy(confs)
+
+
+class Script_Backend():
+    def __init__(self, script_path):
+        torch.backends.quantized.engine = general_config.quantized_engine
+        self.model = torch.jit.load(str(script_path), map_location="cpu")
+        self.model.eval()
+        self.device = torch.device("cpu")
+
+    def to(self, device):
+        # quantized kernels only run on cpu
+        pass
+
+    def __call__(self, images):
+        with torch.no_grad():
+            return self.model(images.cpu())
+
+
+def backend_onnx_path(model, params, model_id):
+    """
+    ONNX file of the onnx backends: exported from model to constants.onnx_backend_model_path, so
+    the files written by custom_inference/export.py are never overwritten, and reused while it is
+    newer than the checkpoint it was exported from
+    """
+    onnx_path = constants.onnx_backend_model_path.format(model_id)
+    checkpoint_path = constants.model_path.format(model_id)
+    if os.path.exists(onnx_path) and os.path.exists(checkpoint_path) and \
+            os.path.getmtime(onnx_path) > os.path.getmtime(checkpoint_path):
+        return onnx_path
+    export_onnx(model, params, onnx_path)
+    return onnx_path
+
+
+def make_backend(name, model, params, device, model_id=None, profile=None):
+    """
+    the ONNX backends export model first (see backend_onnx_path), unless the last export is newer
+    than the checkpoint, Custom_Infernce cross checks their outputs against the eager model
+    the int8 backend loads the last model saved by the quantization pipeline of model_id
+    profile - Execution_Profile of the torch backend, defaults to the one of general_config
+    """
+    model_id = model_id or general_config.model_id
+    if name == TORCH:
+        return Torch_Backend(model, device, profile or Execution_Profile.from_config(),
+                             general_config.compile_inference)
+    if name == INT8:
+        return Script_Backend(constants.quantized_model_path.format(model_id))
+    if name not in (ONNXRUNTIME, OPENCV):
+        raise ValueError("Unknown inference backend: {}".format(name))
+
+    onnx_path = backend_onnx_path(model, params, model_id)
+    if name == ONNXRUNTIME:
+        return Onnxruntime_Backend(onnx_path)
+    return Opencv_Backend(onnx_path)
+
+
+def cross_check(reference, backend, params, batch_size=2, rtol=1e-3, atol=1e-4):
+    """
+    compares the outputs of backend with the ones of the reference (eager) backend on random
+    images, raises if they differ more than the tolerance, returns the max absolute differences
+    """
+    images = torch.randn(batch_size, 3, params.input_height, params.input_width)
+    expected, actual = reference(images), backend(images)
+
+    differences = []
+    for name, e, a in zip(['locs', 'confs'], expected, actual):
+        e, a = e.float().cpu(), a.float().cpu()
+        if e.shape != a.shape:
+            raise RuntimeError("Backend {} output shape mismatch: {} vs {}".format(
+                name, tuple(a.shape), tuple(e.shape)))
+        differences.append((e - a).abs().max().item())
+        if not torch.allclose(e, a, rtol=rtol, atol=atol):
+            raise RuntimeError("Backend outputs differ from eager torch, max abs difference of {}: {}".format(
+                name, differences[-1]))
+    return differences
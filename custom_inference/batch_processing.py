@@ -0,0 +1,203 @@
+import io
+import tarfile
+import zipfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from general_config import general_config
+
+"""
+Many images in one call: used by the /process_images endpoint of run_flask.py
+
+The uploads (image files, or zip / tar archives of images) are decoded by a thread pool (cv2
+releases the GIL) and go through the same path as single images: result cache, batching engine
+queue and its admission control, so they share the forward passes of the other requests.
+The results keep the order of the uploaded files, archive members are expanded in place.
+
+JPEGs much larger than the model input are decoded at 1/2, 1/4 or 1/8 of their resolution
+(libjpeg scaled DCT decode, see decode_reduced), the boxes are still given for the original size
+"""
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+ARCHIVE_EXTENSIONS = {'zip', 'tar', 'gz', 'tgz'}
+
+
+class Undecodable_Image(Exception):
+    pass
+
+
+class Archive_Too_Large(Exception):
+    pass
+
+
+def extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+class Archive_Budget():
+    """
+    images and uncompressed bytes still allowed from the archives of one request, checked against
+    the sizes in the archive headers before any member is read (zip and tar never return more
+    bytes than the header size of a member)
+    """
+
+    def __init__(self, max_members=None, max_member_bytes=None, max_total_bytes=None):
+        self.max_members = max_members or general_config.archive_max_members
+        self.members = self.max_members
+        self.max_member_bytes = max_member_bytes or general_config.archive_max_member_bytes
+        self.total_bytes = max_total_bytes or general_config.archive_max_total_bytes
+
+    def take(self, name, n_bytes):
+        """
+        raises Archive_Too_Large if the member does not fit in what is left
+        """
+        if self.members <= 0:
+            raise Archive_Too_Large("More than {} images in the archives".format(self.max_members))
+        if n_bytes > self.max_member_bytes:
+            raise Archive_Too_Large("{} is larger than {} bytes uncompressed".format(
+                name, self.max_member_bytes))
+        if n_bytes > self.total_bytes:
+            raise Archive_Too_Large("The archives are too large uncompressed")
+        self.members -= 1
+        self.total_bytes -= n_bytes
+
+
+def expand_archive(filename, data, budget=None):
+    """
+    returns the (name, bytes) of the image members of a zip or tar archive, sorted by name
+    budget - Archive_Budget, shared by the archives of a request, raises Archive_Too_Large
+    when the archive does not fit in it
+    """
+    budget = budget or Archive_Budget()
+    members = []
+    if extension(filename) == 'zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and extension(info.filename) in IMAGE_EXTENSIONS:
+                    budget.take(info.filename, info.file_size)
+                    members.append((info.filename, archive.read(info)))
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            # iterated, getmembers would first load the headers of all the members
+            for info in archive:
+                if info.isfile() and extension(info.name) in IMAGE_EXTENSIONS:
+                    budget.take(info.name, info.size)
+                    members.append((info.name, archive.extractfile(info).read()))
+    return sorted(members, key=lambda member: member[0])
+
+
+def collect_uploads(uploads):
+    """
+    uploads - (filename, bytes) of the uploaded files
+    returns the (name, bytes) of every image, in request order, the errors by filename and
+    whether an archive was rejected for its size (general_config.archive_max_*)
+    """
+    images, errors = [], {}
+    too_large = False
+    budget = Archive_Budget()
+    for filename, data in uploads:
+        if extension(filename) in IMAGE_EXTENSIONS:
+            images.append((filename, data))
+        elif extension(filename) in ARCHIVE_EXTENSIONS:
+            try:
+                images.extend((str(Path(filename).stem) + '/' + name, member)
+                              for name, member in expand_archive(filename, data, budget))
+            except (zipfile.BadZipFile, tarfile.TarError, EOFError):
+                errors[filename] = 'Could not read the archive'
+            except Archive_Too_Large as e:
+                errors[filename] = str(e)
+                too_large = True
+        else:
+            errors[filename] = 'File type is not allowed'
+    return images, errors, too_large
+
+
+# (exif orientations with width and height swapped, cv2.imdecode applies the orientation)
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def reduction_flag(data, target_width, target_height):
+    """
+    reads the image header only, returns the cv2.imdecode flag and the (width, height) of the
+    oriented full size image (None if the header can not be read)
+    the largest reduction is picked that still leaves the image at least as large as the target
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            width, height = header.size
+            image_format = header.format
+            orientation = header.getexif().get(0x0112, 1)
+    except Exception:
+        return cv2.IMREAD_COLOR, None
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+
+    if image_format == 'JPEG':
+        for factor, flag in REDUCED_FLAGS:
+            if width // factor >= target_width and height // factor >= target_height:
+                return flag, (width, height)
+    return cv2.IMREAD_COLOR, (width, height)
+
+
+def decode_reduced(data, target_width, target_height):
+    """
+    decodes the image bytes at the lowest resolution that is still at least target sized
+    returns the BGR uint8 image and the (width, height) of the full size image, the boxes
+    predicted on the returned image have to be scaled to it, None if data is not an image
+    """
+    flag, size = reduction_flag(data, target_width, target_height)
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if image is None:
+        return None
+    if size is None or flag == cv2.IMREAD_COLOR:
+        height, width, _ = image.shape
+        size = (width, height)
+    return image, size
+
+
+def decode_resized(data, width, height):
+    """
+    decodes the image bytes and resizes the image to the model input size, a top level function
+    so it can run in a process pool (the small resized image is cheap to send back)
+    returns the resized BGR uint8 image and the (width, height) of the original, None if the
+    bytes are not an image
+    """
+    decoded = decode_reduced(data, width, height)
+    if decoded is None:
+        return None
+    image, size = decoded
+    return cv2.resize(image, (width, height)), size
+
+
+def process_images(detect, images, n_threads=None):
+    """
+    Arguments:
+    detect - function of the image bytes returning its (x1, y1, x2, y2) boxes, raising
+    Undecodable_Image for bytes that are not an image (run_flask.detect: result cache, then
+    decode and the batching engine, with the admission control of the request)
+    images - (name, bytes) of the images
+    n_threads - images in flight, defaults to general_config.decode_threads
+
+    returns the (name, boxes) of the decoded images in order and the names of the undecodable ones
+    raises Queue_Full (or Deadline_Exceeded) if an image is not admitted, the remaining ones are dropped
+    """
+    results, failed = [], []
+    with ThreadPoolExecutor(n_threads or general_config.decode_threads) as executor:
+        futures = [executor.submit(detect, data) for _, data in images]
+        try:
+            for (name, _), future in zip(images, futures):
+                try:
+                    results.append((name, future.result()))
+                except Undecodable_Image:
+                    failed.append(name)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return results, failed
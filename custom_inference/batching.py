@@ -0,0 +1,266 @@
+import time
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+
+import torch
+
+from general_config import general_config
+from utils.metrics import BATCH_SIZE, QUEUE_DEPTH, REJECTED
+
+"""
+Dynamic micro batching in front of Custom_Infernce, for serving concurrent requests
+
+Request threads preprocess their image and put it in a queue. A single scheduler thread waits for
+the first request, then keeps collecting requests until max_batch_size of them are queued or
+max_wait_ms passed since the first one. The batch goes through one forward pass, the outputs are
+postprocessed per image and each request future is resolved with its boxes.
+
+The thresholds of each request are applied in its own postprocessing, so requests with different
+settings share a forward pass, a collected batch is only split by device (one model replica each).
+
+Admission control, so the latency stays within general_config.latency_slo_ms under overload:
+- the queue is served by priority (INTERACTIVE before BULK), then by deadline, then in order
+- the latency of a batch is tracked as an exponentially weighted moving average, the queue depth
+is capped to what can be served within the latency SLO (never above max_queue_size)
+- requests can have a deadline, they are rejected on submit if the estimated wait already
+misses it, and dropped before reaching the model if it passed while they were queued
+submit raises Queue_Full (or Deadline_Exceeded) instead of queueing, the servers answer HTTP 503
+"""
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = {'interactive': INTERACTIVE, 'bulk': BULK}
+
+
+class Bad_Admission(ValueError):
+    pass
+
+
+def parse_admission(deadline_ms=None, priority=None):
+    """
+    deadline_ms - time budget of the request in milliseconds, priority - interactive or bulk
+    (as sent in the X-Deadline-Ms / X-Priority headers or the deadline_ms / priority form fields)
+    returns the deadline and priority arguments of Batching_Engine.submit
+    raises Bad_Admission if the budget is not a finite positive number or the priority is unknown
+    """
+    deadline = None
+    if deadline_ms:
+        try:
+            budget = float(deadline_ms)
+        except ValueError:
+            raise Bad_Admission("The deadline must be a number of milliseconds, got {!r}".format(deadline_ms))
+        # nan fails the comparison too
+        if not 0 < budget < float('inf'):
+            raise Bad_Admission("The deadline must be a positive number of milliseconds, got {!r}".format(
+                deadline_ms))
+        deadline = time.monotonic() + budget / 1000
+
+    priority = (priority or 'interactive').lower()
+    if priority not in PRIORITIES:
+        raise Bad_Admission("The priority must be one of {}, got {!r}".format(
+            ', '.join(sorted(PRIORITIES)), priority))
+    return deadline, PRIORITIES[priority]
+
+
+class Queue_Full(Exception):
+    pass
+
+
+class Deadline_Exceeded(Queue_Full):
+    pass
+
+
+class Inference_Request():
+    def __init__(self, image, size, settings, deadline=None, priority=INTERACTIVE, timer=None):
+        """
+        deadline - time.monotonic() time the result is needed by, None for no deadline
+        timer - Stage_Timer of the client request, gets the forward and postprocess durations
+        """
+        self.image = image
+        self.size = size
+        self.settings = settings
+        self.deadline = deadline
+        self.priority = priority
+        self.timer = timer
+        self.future = Future()
+
+
+class Batching_Engine():
+    def __init__(self, inferer, max_batch_size=None, max_wait_ms=None, max_queue_size=None,
+                 latency_slo_ms=None):
+        """
+        inferer - Custom_Infernce
+        max_batch_size, max_wait_ms, max_queue_size, latency_slo_ms - default to the
+        general_config.max_batch_size, max_batch_wait_ms, max_queue_size and latency_slo_ms
+        """
+        self.inferer = inferer
+        self.max_batch_size = max_batch_size or general_config.max_batch_size
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else general_config.max_batch_wait_ms) / 1000
+        self.max_queue_size = max_queue_size or general_config.max_queue_size
+        self.latency_slo = (latency_slo_ms or general_config.latency_slo_ms) / 1000
+
+        # seconds per batch, until the first batch is measured the cap is max_queue_size
+        self.batch_latency = None
+        self.ewma_alpha = 0.2
+
+        self.queue = queue.PriorityQueue()
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+        # ties are served in submission order, requests are never compared
+        self.counter = itertools.count()
+        self.running = True
+        self.scheduler = threading.Thread(target=self._schedule, name="batch_scheduler", daemon=True)
+        self.scheduler.start()
+
+    def queue_cap(self):
+        """
+        queue depth that can be served within the latency SLO at the measured batch latency
+        """
+        if self.batch_latency is None:
+            return self.max_queue_size
+        batches = max(1, int(self.latency_slo / self.batch_latency) - 1)
+        return max(self.max_batch_size, min(self.max_queue_size, batches * self.max_batch_size))
+
+    def estimated_wait(self, depth):
+        """
+        seconds until a request submitted behind depth queued ones gets its result
+        """
+        if self.batch_latency is None:
+            return 0
+        return (depth // self.max_batch_size + 1) * self.batch_latency + self.max_wait
+
+    def submit(self, image, custom_settings=None, size=None, deadline=None, priority=INTERACTIVE,
+               timer=None):
+        """
+        image - BGR uint8 image
+        custom_settings - Inference_Settings, (nms_threshold, conf_threshold, device) or None
+        size - (width, height) of the original image, if image is already resized
+        deadline - time.monotonic() time after which the result is useless, None for no deadline
+        priority - INTERACTIVE or BULK
+        timer - Stage_Timer of the client request: preprocess, forward (the wall time of the forward
+        passes its images went through, counted once per pass) and postprocess (per image) are added
+        returns a future of the (x1, y1, x2, y2) boxes, as Custom_Infernce.run_inference(modify_image=False)
+        raises Queue_Full if the queue is at its cap, Deadline_Exceeded if the deadline can not be met
+        """
+        if not self.running:
+            raise RuntimeError("The batching engine is stopped")
+        priority = INTERACTIVE if priority is None else priority
+        depth = self.queue.qsize()
+        if depth >= self.queue_cap():
+            REJECTED.inc(reason='queue_full')
+            raise Queue_Full("{} requests are already waiting".format(depth))
+        if deadline is not None and time.monotonic() + self.estimated_wait(depth) > deadline:
+            REJECTED.inc(reason='deadline')
+            raise Deadline_Exceeded("The deadline can not be met with {} requests waiting".format(depth))
+        if size is None:
+            height, width, _ = image.shape
+            size = (width, height)
+        # preprocessing runs in the request thread, in parallel with the model
+        start = time.perf_counter()
+        image = self.inferer.preprocess(image)
+        if timer is not None:
+            timer.add('preprocess', time.perf_counter() - start)
+        request = Inference_Request(image, size, self.inferer.make_settings(custom_settings), deadline,
+                                    priority, timer)
+        order_deadline = deadline if deadline is not None else float('inf')
+        self.queue.put((priority, order_deadline, next(self.counter), request))
+        return request.future
+
+    def infer(self, image, custom_settings=None, timeout=None, size=None, deadline=None,
+              priority=INTERACTIVE, timer=None):
+        return self.submit(image, custom_settings, size, deadline, priority, timer).result(timeout)
+
+    def stop(self):
+        self.running = False
+        # served before anything else
+        self.queue.put((-1, 0, next(self.counter), None))
+        self.scheduler.join()
+
+    def _next_request(self, timeout=None):
+        """
+        next queued request that can still meet its deadline, the expired ones are failed
+        returns None once the engine is stopped, raises queue.Empty after timeout
+        """
+        while True:
+            start = time.monotonic()
+            _, _, _, request = self.queue.get(timeout=timeout)
+            if request is None:
+                self.queue.put((-1, 0, next(self.counter), None))
+                return None
+            if request.deadline is None or time.monotonic() < request.deadline:
+                return request
+            REJECTED.inc(reason='expired')
+            request.future.set_exception(Deadline_Exceeded("The deadline passed in the queue"))
+            if timeout is not None:
+                timeout -= time.monotonic() - start
+                if timeout <= 0:
+                    raise queue.Empty()
+
+    def _collect_batch(self):
+        """
+        blocks for the first request, then waits at most max_wait for the rest of the batch
+        returns None once the engine is stopped
+        """
+        first = self._next_request()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._next_request(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            batch.append(request)
+        return batch
+
+    def _schedule(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.settings.device, []).append(request)
+            for device, requests in groups.items():
+                self._run(device, requests)
+
+    def _run(self, device, requests):
+        BATCH_SIZE.observe(len(requests))
+        start = time.monotonic()
+        try:
+            outputs = self.inferer.forward_batch(torch.stack([request.image for request in requests]),
+                                                 device)
+            forward_time = time.monotonic() - start
+            results = []
+            # image by image (as postprocess_batch does anyway), to time each request
+            for idx, request in enumerate(requests):
+                postprocess_start = time.perf_counter()
+                results.extend(self.inferer.postprocess_batch(
+                    (outputs[0][idx:idx + 1], outputs[1][idx:idx + 1]), [request.size], [request.settings]))
+                if request.timer is not None:
+                    request.timer.add('postprocess', time.perf_counter() - postprocess_start)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        self._update_latency(time.monotonic() - start)
+        # a client request with several images in the batch counts the forward pass once
+        timers = {id(request.timer): request.timer for request in requests if request.timer is not None}
+        for timer in timers.values():
+            timer.add('forward', forward_time)
+        for request, boxes in zip(requests, results):
+            request.future.set_result(boxes)
+
+    def _update_latency(self, seconds):
+        if self.batch_latency is None:
+            self.batch_latency = seconds
+        else:
+            self.batch_latency = self.ewma_alpha * seconds + (1 - self.ewma_alpha) * self.batch_latency
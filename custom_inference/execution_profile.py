@@ -0,0 +1,77 @@
+import contextlib
+import torch
+
+from general_config import general_config
+
+"""
+How the eager torch model is executed at inference time
+
+- channels_last - model weights and inputs in NHWC memory format, oneDNN runs the depth wise
+separable convolutions of MobileNetV2 and of the SSDLite heads much faster this way on cpu
+- inference_mode - torch.inference_mode instead of torch.no_grad, no version counter or view
+tracking on the tensors
+- bf16 - bfloat16 autocast on cpu, only used where the cpu supports it (AVX512-BF16 / AMX), the
+outputs are cast back to float32 for the postprocessing
+
+The default profile comes from general_config, see the benchmark of custom_inference/profile_benchmark.py
+"""
+
+
+def bf16_supported():
+    """
+    True if the cpu has native bfloat16 kernels, emulated bfloat16 is slower than float32
+    """
+    is_supported = getattr(torch.ops.mkldnn, '_is_mkldnn_bf16_supported', None)
+    return is_supported is not None and bool(is_supported())
+
+
+class Execution_Profile():
+    def __init__(self, channels_last=False, inference_mode=True, bf16=False):
+        self.channels_last = channels_last
+        self.inference_mode = inference_mode
+        if bf16 and not bf16_supported():
+            print("bf16 autocast is not supported by this cpu, running in float32")
+            bf16 = False
+        self.bf16 = bf16
+
+    @classmethod
+    def from_config(cls):
+        return cls(general_config.channels_last, general_config.inference_mode,
+                   general_config.bf16_autocast)
+
+    def __repr__(self):
+        return "Execution_Profile(channels_last={}, inference_mode={}, bf16={})".format(
+            self.channels_last, self.inference_mode, self.bf16)
+
+    def prepare_model(self, model):
+        """
+        converts the weights of model in place, done once
+        """
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_input(self, images):
+        if self.channels_last:
+            return images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    def context(self, device=torch.device("cpu")):
+        """
+        context manager the forward pass runs in, bf16 autocast is only used on cpu
+        """
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode() if self.inference_mode else torch.no_grad())
+        if self.bf16 and device.type == "cpu":
+            stack.enter_context(torch.autocast(device_type="cpu", dtype=torch.bfloat16))
+        return stack
+
+    def run(self, model, images):
+        """
+        forward pass of model on images with this profile, returns float32 outputs
+        """
+        with self.context(images.device):
+            outputs = model(self.prepare_input(images))
+        if self.bf16:
+            outputs = tuple(output.float() for output in outputs)
+        return outputs
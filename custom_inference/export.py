@@ -0,0 +1,139 @@
+import json
+import argparse
+import torch
+
+from train.params import Params
+from general_config import constants, anchor_config, classes_config, general_config
+from architectures.detection_postprocess import with_postprocess
+from utils import training
+
+"""
+Exports a trained model into a self contained TorchScript archive, loaded at inference time by
+custom_inference/script_runtime.py without the architectures package
+
+The archive holds the traced model followed by its box decoding and top-K selection (see
+architectures/detection_postprocess.py) and a meta.json extra file with everything the NMS needs
+(input size, thresholds, class ids)
+
+The export is traced only: the model forwards (MobileNetV2._forward_features indexing its layers
+with a loop variable, bbox_view with its optional fused heads) are not written for torch.jit.script
+
+The raw model (locs, confs outputs, dynamic batch size) can also be exported to ONNX, to be run by
+the onnxruntime and cv2.dnn backends of custom_inference/backends.py, or, with --postprocess,
+the same model + postprocessing as the TorchScript archive
+
+Usage: python -m custom_inference.export --model_id ssdlite [--format onnx [--postprocess]]
+"""
+
+
+def export_meta(model_id, params, top_k=200):
+    """
+    settings of the model_id needed by the standalone runtime
+    """
+    training_ids = classes_config.model_to_ids[model_id]
+    return {
+        'model_id': model_id,
+        'input_size': [params.input_height, params.input_width],
+        'mean': [0.485, 0.456, 0.406],
+        'std': [0.229, 0.224, 0.225],
+        'conf_threshold': params.conf_threshold,
+        'nms_threshold': params.suppress_threshold,
+        'agnostic_nms': general_config.agnostic_nms,
+        'top_k': top_k,
+        # category id of each class index, the background is not part of the scores
+        'class_ids': training_ids[:-1],
+    }
+
+
+def deploy_detector_setup(model_id, params, top_k=200):
+    """
+    trained model of model_id followed by its postprocessing, on cpu, in eval mode
+    """
+    model = training.inference_model_setup(params, model_id)
+    anchors_xywh = anchor_config.get_default_boxes(model_id)(order="xywh")
+    return with_postprocess(model.cpu(), anchors_xywh, params, top_k).eval()
+
+
+def export_model(model_id=None, output_path=None, top_k=200):
+    """
+    Arguments:
+    model_id - one of ssdlite, resnetssd, ssdlite_1_class, defaults to general_config.model_id
+    output_path - defaults to constants.exported_model_path
+    top_k - number of detections per image given to the NMS
+
+    the weights are read from the model checkpoint of model_id, the archive is made on cpu and can
+    be mapped to any device when loaded
+    """
+    model_id = model_id or general_config.model_id
+    output_path = output_path or constants.exported_model_path.format(model_id)
+    params = Params(constants.params_path.format(model_id))
+
+    detector = deploy_detector_setup(model_id, params, top_k)
+
+    example = torch.randn(1, 3, params.input_height, params.input_width)
+    with torch.no_grad():
+        exported = torch.jit.freeze(torch.jit.trace(detector, example))
+
+        # the exported graph has to match the eager model
+        expected, actual = detector(example), exported(example)
+        for e, a in zip(expected, actual):
+            if not torch.allclose(e.float(), a.float(), rtol=1e-3, atol=1e-4):
+                raise RuntimeError("Exported {} outputs differ from the eager model".format(model_id))
+
+    meta = export_meta(model_id, params, top_k)
+    torch.jit.save(exported, str(output_path), _extra_files={'meta.json': json.dumps(meta)})
+    print("Exported {} to {}".format(model_id, output_path))
+    return output_path
+
+
+def export_onnx(model, params, output_path, opset_version=11, output_names=('locs', 'confs')):
+    """
+    exports the raw outputs of model: locs B x 4 x #anchors and confs B x #classes x #anchors
+    (or B x #anchors x 4 and B x #anchors x #classes for anchor major models)
+    or, for a Deploy_Detector, its boxes, scores and class_ids
+    the batch dimension is dynamic
+    """
+    was_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    example = torch.randn(1, 3, params.input_height, params.input_width, device=device)
+
+    with torch.no_grad():
+        torch.onnx.export(model, example, str(output_path), opset_version=opset_version,
+                          input_names=['images'], output_names=list(output_names),
+                          dynamic_axes={name: {0: 'batch'} for name in ['images', *output_names]})
+    model.train(was_training)
+    print("Exported ONNX model to {}".format(output_path))
+    return output_path
+
+
+def export_onnx_model(model_id=None, output_path=None, postprocess=False, top_k=200):
+    """
+    ONNX export of the checkpoint of model_id, defaults to constants.onnx_model_path
+    postprocess - include the box decoding and top-K selection, see Deploy_Detector
+    """
+    model_id = model_id or general_config.model_id
+    output_path = output_path or constants.onnx_model_path.format(model_id)
+    params = Params(constants.params_path.format(model_id))
+
+    if postprocess:
+        return export_onnx(deploy_detector_setup(model_id, params, top_k), params, output_path,
+                           output_names=('boxes', 'scores', 'class_ids'))
+    model = training.inference_model_setup(params, model_id)
+    return export_onnx(model.cpu(), params, output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a trained model to TorchScript or ONNX")
+    parser.add_argument('--model_id', default=None,
+                        choices=[constants.ssdlite, constants.ssd, constants.ssd_modified])
+    parser.add_argument('--output_path', default=None)
+    parser.add_argument('--format', default="torchscript", choices=["torchscript", "onnx"])
+    parser.add_argument('--postprocess', action='store_true',
+                        help="include the box decoding and top-K in the ONNX graph")
+    parser.add_argument('--top_k', type=int, default=200)
+    args = parser.parse_args()
+    if args.format == "onnx":
+        export_onnx_model(args.model_id, args.output_path, args.postprocess, args.top_k)
+    else:
+        export_model(args.model_id, args.output_path, args.top_k)
@@ -0,0 +1,114 @@
+import copy
+import time
+import argparse
+import itertools
+import torch
+
+from train.params import Params
+from general_config import constants
+from utils import training
+from custom_inference.execution_profile import Execution_Profile, bf16_supported
+from architectures import fusion
+
+"""
+Cpu latency of every execution profile combination (channels_last x inference_mode x bf16),
+for each model_id, on random images of the model input size
+
+Usage: python -m custom_inference.profile_benchmark [--model_ids ssdlite resnetssd] [--batch_size 1]
+The fastest profile can then be set in general_config (channels_last, inference_mode, bf16_autocast)
+
+Each model is also timed with its loc and conf heads merged (general_config.fuse_heads) against the
+separate heads, with the profile of general_config
+"""
+
+
+def time_profile(model, profile, images, runs=50, warm_up=5):
+    """
+    mean time of one forward pass, the first warm_up runs (oneDNN kernel selection, weight
+    reorders) are not counted
+    """
+    for _ in range(warm_up):
+        profile.run(model, images)
+    start = time.perf_counter()
+    for _ in range(runs):
+        profile.run(model, images)
+    return (time.perf_counter() - start) / runs
+
+
+def benchmark_model(model_id, batch_size=1, runs=50, n_threads=None):
+    """
+    returns a list of (profile, mean time, max abs difference of the outputs to the float32 NCHW ones)
+    """
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    params = Params(constants.params_path.format(model_id))
+    model = training.inference_model_setup(params, model_id).cpu()
+    images = torch.randn(batch_size, 3, params.input_height, params.input_width)
+
+    reference = Execution_Profile(inference_mode=False).run(model, images)
+    bf16_options = [False, True] if bf16_supported() else [False]
+
+    results = []
+    for channels_last, inference_mode, bf16 in itertools.product([False, True], [False, True], bf16_options):
+        profile = Execution_Profile(channels_last, inference_mode, bf16)
+        profile_model = profile.prepare_model(copy.deepcopy(model))
+        mean_time = time_profile(profile_model, profile, images, runs)
+        outputs = profile.run(profile_model, images)
+        difference = max((e - a).abs().max().item() for e, a in zip(reference, outputs))
+        results.append((profile, mean_time, difference))
+    return results
+
+
+def compare_fused_heads(model_id, batch_size=1, runs=50):
+    """
+    returns the mean forward time with separate heads, with fused heads, and the max abs
+    difference of their outputs, both with the execution profile of general_config
+    """
+    params = Params(constants.params_path.format(model_id))
+    model = training.inference_model_setup(params, model_id).cpu()
+    fused_model = fusion.fuse_heads(copy.deepcopy(model))
+    images = torch.randn(batch_size, 3, params.input_height, params.input_width)
+
+    profile = Execution_Profile.from_config()
+    times, outputs = [], []
+    for candidate in (model, fused_model):
+        candidate = profile.prepare_model(candidate)
+        times.append(time_profile(candidate, profile, images, runs))
+        outputs.append(profile.run(candidate, images))
+    difference = max((e - a).abs().max().item() for e, a in zip(*outputs))
+    return times[0], times[1], difference
+
+
+def print_fused_heads(separate_time, fused_time, difference):
+    print("Heads: separate {:.2f} ms, fused {:.2f} ms, speedup {:.2f}, max diff {:.2e}".format(
+        separate_time * 1000, fused_time * 1000, separate_time / fused_time, difference))
+    print("Set general_config.fuse_heads = {}\n".format(fused_time < separate_time))
+
+
+def print_results(model_id, results):
+    baseline = results[0][1]
+    print("Model: {}".format(model_id))
+    print("{:<15}{:<16}{:<6}{:>10}{:>10}{:>12}".format(
+        "channels_last", "inference_mode", "bf16", "time (ms)", "speedup", "max diff"))
+    for profile, mean_time, difference in results:
+        print("{:<15}{:<16}{:<6}{:>10.2f}{:>10.2f}{:>12.2e}".format(
+            str(profile.channels_last), str(profile.inference_mode), str(profile.bf16),
+            mean_time * 1000, baseline / mean_time, difference))
+    print("--------------------------------------\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the cpu execution profiles")
+    parser.add_argument('--model_ids', nargs='+',
+                        default=[constants.ssdlite, constants.ssd, constants.ssd_modified],
+                        choices=[constants.ssdlite, constants.ssd, constants.ssd_modified])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--n_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if not bf16_supported():
+        print("This cpu has no native bf16 support, the bf16 profiles are skipped\n")
+    for model_id in args.model_ids:
+        print_results(model_id, benchmark_model(model_id, args.batch_size, args.runs, args.n_threads))
+        print_fused_heads(*compare_fused_heads(model_id, args.batch_size, args.runs))
@@ -0,0 +1,65 @@
+import time
+import torch
+
+from train.params import Params
+from train.validate import Model_evaluator
+from general_config import constants, general_config
+from architectures import quantization
+from custom_inference import backends
+from custom_inference.speed_test import Speed_testing
+from data import dataloaders
+from utils import training
+
+"""
+Post training int8 quantization of the current SSDLite model (general_config.model_id)
+
+Usage: python -m custom_inference.quantize
+Saves the int8 model to constants.quantized_model_path, used by Custom_Infernce(backend="int8"),
+then reports the mAP and cpu latency of both the fp32 and the int8 model
+"""
+
+
+def run_ptq(n_calibration_images=300, evaluate=True, speed_runs=3, speed_images=100):
+    """
+    Arguments:
+    n_calibration_images - validation images used to observe the activation ranges
+    evaluate - compute the mAP of both models on the whole validation set
+    speed_runs, speed_images - Speed_testing settings for the latency comparison
+    """
+    if general_config.model_id == constants.ssd:
+        raise ValueError("Quantization is only supported for the SSDLite models")
+    params = Params(constants.params_path.format(general_config.model_id))
+
+    model = training.model_setup(params)
+    model = training.load_weigths_only(model, params)
+    model.eval()
+
+    valid_loader = dataloaders.get_valid_dataloader(params)
+    start = time.time()
+    quantized_model = quantization.quantize_static(model, valid_loader, n_calibration_images)
+    print("Quantization took {:.1f}s".format(time.time() - start))
+    print("Model size: fp32 {:.2f} MB, int8 {:.2f} MB".format(
+        quantization.model_size(model), quantization.model_size(quantized_model)))
+    quantization.save_quantized(quantized_model, params,
+                                constants.quantized_model_path.format(general_config.model_id))
+
+    results = {}
+    if evaluate:
+        model_evaluator = Model_evaluator(valid_loader, params=params)
+        results['fp32_mAP'] = model_evaluator.only_mAP(model)
+        results['int8_mAP'] = model_evaluator.only_mAP(quantized_model, device=torch.device("cpu"))
+
+    cpu_settings = (params.suppress_threshold, params.conf_threshold, torch.device("cpu"))
+    for name, backend in (('fp32', backends.TORCH), ('int8', backends.INT8)):
+        speed_tester = Speed_testing(runs=speed_runs, n_images=speed_images, backend=backend)
+        results[name + '_latency'] = speed_tester.speed_test(custom_settings=cpu_settings)
+
+    print("Post training quantization results:")
+    for name in ('fp32', 'int8'):
+        print("{}: mAP {}, mean cpu model time {:.4f}s".format(
+            name, results.get(name + '_mAP', "not evaluated"), results[name + '_latency']))
+    return results
+
+
+if __name__ == '__main__':
+    run_ptq()
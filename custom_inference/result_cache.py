@@ -0,0 +1,150 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from utils.metrics import CACHE_EVENTS
+
+"""
+Content addressed cache of the detections, for clients resubmitting identical images
+
+The key is the hash of the uploaded bytes with the model id and the inference settings, the
+entries are kept in LRU order, at most max_entries of them, each for ttl seconds. Identical
+requests arriving while the first one is still running wait for its result instead of running
+the model again (coalescing). The cached values are returned as copies, callers can modify them.
+The hits, misses, coalesced requests, evictions, expirations and releases are also Prometheus
+counters (detector_cache_events_total).
+
+An owner can also release its key without a value (it was not admitted by the batching engine,
+see retry_on of get_or_compute): the waiting requests then look the key up again, one of them
+becomes the new owner, so each request is only rejected by its own deadline and priority.
+"""
+
+# result of the futures of a released key
+RETRY = object()
+
+
+def cache_key(data, model_id, settings):
+    """
+    data - uploaded bytes, settings - Inference_Settings
+    """
+    return (hashlib.sha256(data).hexdigest(), model_id, tuple(settings))
+
+
+class Result_Cache():
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'expired': 0, 'released': 0}
+
+    def _count(self, event):
+        """
+        called with the lock held, also counted in the CACHE_EVENTS metric of /metrics
+        """
+        self.stats[event] += 1
+        CACHE_EVENTS.inc(event=event)
+
+    def lookup(self, key):
+        """
+        returns (future, owner): if owner, the caller has to compute the value and call resolve
+        (or fail, or release), otherwise the future gives the cached or in flight value, or RETRY
+        if the owner released the key
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self._count('hits')
+                    future = Future()
+                    future.set_result(_copy(value))
+                    return future, False
+                del self.entries[key]
+                self._count('expired')
+
+            if key in self.in_flight:
+                self._count('coalesced')
+                return _copying_future(self.in_flight[key]), False
+
+            self._count('misses')
+            future = Future()
+            self.in_flight[key] = future
+            return future, True
+
+    def resolve(self, key, value):
+        with self.lock:
+            future = self.in_flight.pop(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self._count('evictions')
+        future.set_result(value)
+
+    def fail(self, key, exception):
+        """
+        errors are not cached, the waiting requests get the exception
+        """
+        with self.lock:
+            future = self.in_flight.pop(key)
+        future.set_exception(exception)
+
+    def release(self, key):
+        """
+        the owner gives up without a value, the waiting requests get RETRY and look the key up again
+        """
+        with self.lock:
+            future = self.in_flight.pop(key)
+            self._count('released')
+        future.set_result(RETRY)
+
+    def get_or_compute(self, key, compute, retry_on=()):
+        """
+        retry_on - exception types that only concern the computing request (admission rejections),
+        they release the key instead of being passed to the waiting requests
+        """
+        while True:
+            future, owner = self.lookup(key)
+            if owner:
+                break
+            value = future.result()
+            if value is not RETRY:
+                return value
+        try:
+            value = compute()
+        except retry_on:
+            self.release(key)
+            raise
+        except Exception as e:
+            self.fail(key, e)
+            raise
+        self.resolve(key, value)
+        return _copy(value)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), in_flight=len(self.in_flight))
+
+
+def _copy(value):
+    return value.copy() if hasattr(value, 'copy') else value
+
+
+def _copying_future(future):
+    """
+    future of a copy of the result of future, so every waiting request gets its own value
+    """
+    copied = Future()
+
+    def done(source):
+        if source.exception() is not None:
+            copied.set_exception(source.exception())
+        else:
+            copied.set_result(_copy(source.result()))
+    future.add_done_callback(done)
+    return copied
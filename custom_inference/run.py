@@ -1,25 +1,78 @@
+import copy
+import threading
 import torch
 import cv2
 import torchvision.transforms.functional as F
 from pathlib import Path
+from collections import namedtuple
 
 from train.params import Params
 from misc.model_output_handler import Model_output_handler
 from general_config import constants, general_config
 from utils import training
 from utils.postprocessing import nms, postprocess_until_nms, clip_boxes
-from utils.box_computations import wh2corners_numpy
+from utils.box_computations import wh2corners_numpy, to_anchor_major
+from custom_inference import backends
+from utils.metrics import timed
+
+# per call options of Custom_Infernce, immutable so they can be shared between threads
+Inference_Settings = namedtuple('Inference_Settings', ['nms_threshold', 'conf_threshold', 'device'])
+
+
+class Bad_Device(ValueError):
+    pass
+
+
+def serving_device(device):
+    """
+    device asked for by a served request, as given to make_settings
+    raises Bad_Device if it is not one of general_config.serving_devices, a model replica is only
+    ever made for those
+    """
+    try:
+        parsed = torch.device(device)
+    except (RuntimeError, TypeError):
+        raise Bad_Device("Unknown device {!r}".format(device))
+    # a bare cuda is the first gpu
+    name = 'cuda:0' if parsed.type == 'cuda' and parsed.index is None else str(parsed)
+    allowed = {str(torch.device(allowed_device)) for allowed_device in general_config.serving_devices}
+    if name not in allowed:
+        raise Bad_Device("Device {!r} is not served, use one of {}".format(
+            device, ', '.join(general_config.serving_devices)))
+    return name
 
 
 class Custom_Infernce():
-    def __init__(self):
+    def __init__(self, backend=backends.TORCH, profile=None):
+        """
+        backend - torch, onnxruntime, opencv (cv2.dnn) or int8, see custom_inference/backends.py
+        the ONNX backends are checked against the eager model when created
+        profile - Execution_Profile of the torch backend, defaults to the one of general_config
+
+        the instance is not modified by inference calls, so it can be shared by request threads:
+        the settings of each call are passed through, and the torch backend keeps one model
+        replica per device, made the first time a device is asked for
+        """
         self.params = Params(constants.params_path.format(general_config.model_id))
         self.device = general_config.device
+        self.backend_name = backend
+        self.profile = profile
 
-        self.model = training.model_setup(self.params)
-        self.model = training.load_weigths_only(self.model, self.params)
+        fuse_heads = general_config.fuse_heads and backend == backends.TORCH
+        self.model = training.inference_model_setup(self.params, fuse_heads=fuse_heads)
         self.model = self.model.to(self.device)
-        self.model.eval()
+
+        self.backend = backends.make_backend(backend, self.model, self.params, self.device,
+                                             profile=profile)
+        if backend in (backends.ONNXRUNTIME, backends.OPENCV):
+            differences = backends.cross_check(backends.Torch_Backend(self.model, self.device),
+                                               self.backend, self.params)
+            print("Backend {} matches eager torch, max abs differences: {}".format(backend, differences))
+        self.device = self.backend.device
+        self.replicas = {torch.device(self.device): self.backend}
+        self.replicas_lock = threading.Lock()
+        self.default_settings = Inference_Settings(self.params.suppress_threshold,
+                                                   self.params.conf_threshold, str(self.device))
 
         self.output_handler = Model_output_handler(self.params)
         self.source_dir = Path.cwd() / "custom_inference" / "samples"
@@ -28,50 +81,103 @@ class Custom_Infernce():
         self.source_video_dir = Path.cwd() / "custom_inference" / "video_sample" / "video.mp4"
         self.save_video_dir = Path.cwd() / "custom_inference" / "video_output" / "video.mp4"
 
-    def run_inference(self, image, modify_image=True, custom_settings=None):
+    def run_inference(self, image, modify_image=True, custom_settings=None, size=None):
         """
-        If modify_image flag is True, the boxes are drawn on the given image, otherwise this
-        function just returns the predicted boxes
+        If modify_image flag is True, the boxes are drawn on a copy of the given image, otherwise
+        this function just returns the predicted boxes (and the image is not copied)
+        size - (width, height) the boxes are given for, if image is a reduced decode of a larger
+        image (see decode_reduced of custom_inference/batch_processing.py), defaults to the image size
 
-        custom_settings, if set, should be a tuple of (nms_threshold, conf_threshold, device), this
+        custom_settings, if set, should be an Inference_Settings or a tuple of
+        (nms_threshold, conf_threshold, device), used only for this call
         device - cuda:0 or cpu
-        !!! overwrites the original settings
         """
-        if custom_settings:
-            print("Current custom settings: ", custom_settings)
-            nms_thresh, conf_thresh, device = custom_settings
-            self.output_handler.suppress_threshold = nms_thresh
-            self.output_handler.confidence_threshold = conf_thresh
-            self.device = device
-            self.model.to(self.device)
-        with torch.no_grad():
-            original_image = image.copy()
-            heigth, width, _ = original_image.shape
-
-            image = cv2.resize(image, (300, 300))
+        if modify_image and size is not None:
+            raise ValueError("The boxes can only be drawn on a full size image")
+        settings = self.make_settings(custom_settings)
+        heigth, width, _ = image.shape
+        if size is not None:
+            width, heigth = size
+
+        outputs = self.forward_batch(self.preprocess(image).unsqueeze(dim=0), settings.device)
+        boxes = self.postprocess_batch(outputs, [(width, heigth)], [settings])[0]
+        if modify_image:
+            image = self.plot_boxes(image.copy(), boxes)
+            return image
+        return boxes
+
+    def make_settings(self, custom_settings=None):
+        """
+        Inference_Settings of a call, the defaults of params.json if custom_settings is None
+        """
+        if custom_settings is None:
+            return self.default_settings
+        return Inference_Settings(*custom_settings)
+
+    def backend_for(self, device):
+        """
+        backend whose model lives on device, cpu only backends serve every device
+        """
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        backend = self.replicas.get(device)
+        if backend is not None:
+            return backend
+        if self.backend_name != backends.TORCH:
+            return self.backend
+        with self.replicas_lock:
+            if device not in self.replicas:
+                print("Creating a model replica on ", device)
+                replica = copy.deepcopy(self.model).to(device)
+                self.replicas[device] = backends.make_backend(backends.TORCH, replica, self.params,
+                                                              device, profile=self.profile)
+            return self.replicas[device]
+
+    def preprocess(self, image):
+        """
+        BGR uint8 image of any size -> 3 x input_height x input_width normalized tensor, on cpu
+        """
+        with timed('preprocess'):
+            image = cv2.resize(image, (self.params.input_width, self.params.input_height))
             image = F.to_tensor(image)
-            image = F.normalize(image, mean=[0.485, 0.456, 0.406],
-                                std=[0.229, 0.224, 0.225])
+            return F.normalize(image, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
-            image = image.to(self.device)
-            image = image.unsqueeze(dim=0)
-            boxes, confs = self.model(image)
-            boxes = boxes.squeeze().permute(1, 0)
-            confs = confs.squeeze().permute(1, 0)
+    def forward_batch(self, images, device=None):
+        """
+        images - B x 3 x input_height x input_width tensor of preprocessed images
+        device - the replica to run on, defaults to the one of the default settings
+        returns the model outputs as B x #anchors x 4 and B x #anchors x n_classes cpu tensors
+        """
+        backend = self.backend_for(device or self.default_settings.device)
+        with torch.no_grad(), timed('forward'):
+            boxes, confs = to_anchor_major(backend(images.to(backend.device)), self.params)
+            # a single device to host copy for the whole batch
+            return boxes.cpu(), confs.cpu()
 
-            boxes, classes = postprocess_until_nms(self.output_handler, boxes,
-                                                   confs, (width, heigth))
+    def postprocess_batch(self, outputs, sizes, settings=None):
+        """
+        outputs - forward_batch outputs, sizes - (width, height) of each original image
+        settings - Inference_Settings of each image, only their thresholds are used here,
+        defaults to the params.json ones
+        returns the (x1, y1, x2, y2) int boxes kept by the nms, clipped to each image
+        """
+        settings = settings or [self.default_settings] * len(sizes)
+        batch_boxes = []
+        for boxes, confs, (width, heigth), image_settings in zip(*outputs, sizes, settings):
+            with timed('threshold'):
+                boxes, classes = postprocess_until_nms(self.output_handler, boxes, confs, (width, heigth),
+                                                       image_settings.conf_threshold)
 
-            boxes = wh2corners_numpy(boxes[:, :2], boxes[:, 2:])
-            kept_indeces = nms(boxes, classes, self.output_handler.suppress_threshold)
+            with timed('nms'):
+                boxes = wh2corners_numpy(boxes[:, :2], boxes[:, 2:])
+                kept_indeces = nms(boxes, classes, image_settings.nms_threshold)
 
             boxes = boxes[kept_indeces].astype(int)
             # clip values in image range
             clip_boxes(boxes, width, heigth)
-            if modify_image:
-                image = self.plot_boxes(original_image, boxes)
-                return image
-            return boxes
+            batch_boxes.append(boxes)
+        return batch_boxes
 
     def run_image(self):
         print("Source directory: ", self.source_dir)
@@ -0,0 +1,118 @@
+import json
+import argparse
+import numpy as np
+import torch
+import cv2
+
+"""
+Standalone inference on a TorchScript archive made by custom_inference/export.py
+
+Only torch, numpy and cv2 are needed, nothing from this repo is imported, so this file can be
+copied next to the .pt archive on the deployment machine
+
+Usage: python script_runtime.py model_scripted.pt image.jpg [--output out.jpg]
+"""
+
+
+def nms_numpy(boxes, classes, threshold, agnostic=True, top_k=200):
+    """
+    greedy non maximum suppression on (x1, y1, x2, y2) boxes sorted decreasingly by score
+    returns the indices of the kept boxes
+    """
+    boxes, classes = boxes[:top_k], classes[:top_k]
+    if boxes.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    if not agnostic:
+        # boxes of different classes never overlap once shifted apart
+        offsets = classes.astype(np.float32) * (boxes.max() + 1)
+        boxes = boxes + offsets[:, None]
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.arange(boxes.shape[0])
+    kept = []
+    while order.size > 0:
+        i = order[0]
+        kept.append(i)
+        x1 = np.maximum(boxes[i, 0], boxes[order[1:], 0])
+        y1 = np.maximum(boxes[i, 1], boxes[order[1:], 1])
+        x2 = np.minimum(boxes[i, 2], boxes[order[1:], 2])
+        y2 = np.minimum(boxes[i, 3], boxes[order[1:], 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        iou = intersection / (areas[i] + areas[order[1:]] - intersection)
+        order = order[1:][iou < threshold]
+    return np.array(kept, dtype=np.int64)
+
+
+class Script_Detector():
+    """
+    loads an exported archive and runs the whole detection pipeline on single images
+    """
+
+    def __init__(self, archive_path, device="cpu", conf_threshold=None, nms_threshold=None):
+        extra_files = {'meta.json': ''}
+        self.device = torch.device(device)
+        self.model = torch.jit.load(str(archive_path), map_location=self.device,
+                                    _extra_files=extra_files)
+        self.model.eval()
+        self.meta = json.loads(extra_files['meta.json'])
+
+        self.height, self.width = self.meta['input_size']
+        self.mean = np.array(self.meta['mean'], dtype=np.float32)
+        self.std = np.array(self.meta['std'], dtype=np.float32)
+        self.class_ids = np.array(self.meta['class_ids'])
+        self.conf_threshold = conf_threshold or self.meta['conf_threshold']
+        self.nms_threshold = nms_threshold or self.meta['nms_threshold']
+
+    def preprocess(self, image):
+        """
+        same as Custom_Infernce: resize, scale to [0, 1] and normalize, channels are not reordered
+        """
+        image = cv2.resize(image, (self.width, self.height))
+        image = (image.astype(np.float32) / 255 - self.mean) / self.std
+        image = torch.from_numpy(image.transpose(2, 0, 1)).unsqueeze(dim=0)
+        return image.to(self.device)
+
+    def postprocess(self, boxes, scores, classes, width, height):
+        """
+        boxes, scores, classes - outputs of one image: the top-K detections sorted decreasingly by score,
+        (x1, y1, x2, y2) boxes relative to the image size and class indices
+        returns (x1, y1, x2, y2) int boxes in image coordinates, their category ids and scores
+        """
+        boxes, confidences, classes = boxes.cpu().numpy(), scores.cpu().numpy(), classes.cpu().numpy()
+
+        # already sorted, the kept detections are a prefix
+        keep = confidences > self.conf_threshold
+        boxes, classes, confidences = boxes[keep], classes[keep], confidences[keep]
+        boxes = boxes * np.array([width, height, width, height], dtype=np.float32)
+
+        kept = nms_numpy(boxes, classes, self.nms_threshold, self.meta['agnostic_nms'], self.meta['top_k'])
+        boxes = boxes[kept].astype(int)
+        boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, width - 1)
+        boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, height - 1)
+        return boxes, self.class_ids[classes[kept]], confidences[kept]
+
+    def __call__(self, image):
+        height, width, _ = image.shape
+        with torch.no_grad():
+            boxes, scores, classes = self.model(self.preprocess(image))
+        return self.postprocess(boxes[0], scores[0], classes[0], width, height)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run an exported detector on an image")
+    parser.add_argument('archive')
+    parser.add_argument('image')
+    parser.add_argument('--output', default=None, help="where to save the image with the boxes")
+    parser.add_argument('--device', default="cpu")
+    args = parser.parse_args()
+
+    detector = Script_Detector(args.archive, args.device)
+    image = cv2.imread(args.image)
+    boxes, class_ids, confidences = detector(image)
+    for box, class_id, confidence in zip(boxes, class_ids, confidences):
+        print(class_id, "{:.3f}".format(confidence), box.tolist())
+
+    if args.output:
+        for x1, y1, x2, y2 in boxes:
+            cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
+        cv2.imwrite(args.output, image)
@@ -0,0 +1,64 @@
+import json
+import struct
+import numpy as np
+
+"""
+Response encodings of the /process_image endpoints, picked from the Accept header of the request
+
+- application/json (default) - {"data": {"boxes": [[x, y, w, h], ...]}, "time_taken": "0.012"},
+encoded in a single pass, the int boxes are converted to python ints by ndarray.tolist
+- application/x-detections - a 16 byte little endian header followed by the boxes:
+    magic b'DETS' | version uint16 | coordinate bytes uint16 (2 or 4) | n_boxes uint32 | time_taken float32
+    n_boxes x 4 (x, y, w, h) int16 (int32 if a coordinate does not fit in int16)
+"""
+
+JSON_MIMETYPE = "application/json"
+BINARY_MIMETYPE = "application/x-detections"
+
+BINARY_MAGIC = b'DETS'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHIf')
+
+
+def negotiate(accept_header):
+    """
+    mimetype of the response, the binary format only if the client explicitly accepts it
+    """
+    if accept_header and BINARY_MIMETYPE in accept_header:
+        return BINARY_MIMETYPE
+    return JSON_MIMETYPE
+
+
+def encode_json(boxes, time_taken):
+    """
+    boxes - n x 4 int ndarray of (x, y, w, h) boxes, time_taken - seconds
+    """
+    return json.dumps({'data': {'boxes': boxes.tolist()},
+                       'time_taken': "{:.3f}".format(time_taken)}).encode()
+
+
+def encode_binary(boxes, time_taken):
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    info = np.iinfo(np.int16)
+    fits_int16 = boxes.size == 0 or (boxes.min() >= info.min and boxes.max() <= info.max)
+    dtype = np.dtype('<i2') if fits_int16 else np.dtype('<i4')
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, dtype.itemsize, boxes.shape[0], time_taken)
+    return header + boxes.astype(dtype).tobytes()
+
+
+def decode_binary(body):
+    """
+    client side inverse of encode_binary, returns the boxes and the time taken
+    """
+    magic, version, itemsize, n_boxes, time_taken = BINARY_HEADER.unpack_from(body)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a version {} detections response".format(BINARY_VERSION))
+    dtype = np.dtype('<i2') if itemsize == 2 else np.dtype('<i4')
+    boxes = np.frombuffer(body, dtype=dtype, count=n_boxes * 4, offset=BINARY_HEADER.size)
+    return boxes.reshape(n_boxes, 4), time_taken
+
+
+def encode(boxes, time_taken, mimetype):
+    if mimetype == BINARY_MIMETYPE:
+        return encode_binary(boxes, time_taken)
+    return encode_json(boxes, time_taken)
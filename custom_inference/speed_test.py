@@ -1,26 +1,30 @@
-import time
 import torch
 
 from train.params import Params
 from misc.model_output_handler import Model_output_handler
 from general_config import constants, general_config
 from utils import training
-from utils.box_computations import wh2corners_numpy
+from utils.box_computations import wh2corners_numpy, to_anchor_major
 from utils.postprocessing import nms, postprocess_until_nms
 from data import dataloaders
+from custom_inference import backends
+from utils.metrics import Stage_Timer
 
 
 class Speed_testing():
-    def __init__(self, runs=10, n_images=100, print_each_run=False):
+    def __init__(self, runs=10, n_images=100, print_each_run=False, backend=backends.TORCH,
+                 profile=None):
         self.runs = runs
         self.n_images = n_images
         self.device = general_config.device
         self.params = Params(constants.params_path.format(general_config.model_id))
 
-        self.model = training.model_setup(self.params)
-        self.model = training.load_weigths_only(self.model, self.params)
+        fuse_heads = general_config.fuse_heads and backend == backends.TORCH
+        self.model = training.inference_model_setup(self.params, fuse_heads=fuse_heads)
         self.model = self.model.to(self.device)
-        self.model.eval()
+        self.backend = backends.make_backend(backend, self.model, self.params, self.device,
+                                             profile=profile)
+        self.device = self.backend.device
 
         self.output_handler = Model_output_handler(self.params)
         self.print_each_run = print_each_run
@@ -33,66 +37,58 @@ class Speed_testing():
         custom_settings, if set, should be a tuple of (nms_threshold, conf_threshold, device), this
         device - cuda:0 or cpu
         !!! overwrites the original settings
+
+        returns the mean time taken by the model for one image
         """
         if custom_settings:
             print("Current custom settings: ", custom_settings)
             nms_thresh, conf_thresh, device = custom_settings
             self.output_handler.suppress_threshold = nms_thresh
             self.output_handler.confidence_threshold = conf_thresh
-            self.device = device
-            self.model.to(self.device)
-
-        run = 0
-        total_time_model, total_time_pre_nms, total_time_nms, in_nms_boxes = 0, 0, 0, 0
-        while run < self.runs:
-            c_img = 0
-            times_model, times_pre_nms, times_nms, in_nms_boxes = 0, 0, 0, 0
+            self.backend.to(device)
+            self.device = self.backend.device
+
+        total_timer = Stage_Timer()
+        for _ in range(self.runs):
+            timer = Stage_Timer()
+            in_nms_boxes = 0
             self.valid_loader_iter = iter(self.valid_loader)
-            while c_img < self.n_images:
-                (boxes, confs), image_info, last_model = self.val_image_output()
-                times_model += last_model
+            for _ in range(self.n_images):
+                (boxes, confs), image_info = self.val_image_output(timer)
 
-                start_pre_nms = time.time()
-                boxes, classes = postprocess_until_nms(self.output_handler, boxes,
-                                                       confs, image_info[0][1])
-                last_pre_nms = time.time() - start_pre_nms
-                times_pre_nms += last_pre_nms
+                with timer.stage('pre_nms'):
+                    boxes, classes = postprocess_until_nms(self.output_handler, boxes,
+                                                           confs, image_info[0][1])
 
                 boxes = wh2corners_numpy(boxes[:, :2], boxes[:, 2:])
-                start_nms = time.time()
-                boxes = boxes[:200]
-                in_nms_boxes += len(boxes)
-                _ = nms(boxes, classes, self.output_handler.suppress_threshold)
-                last_nms = time.time() - start_nms
-                times_nms += last_nms
-                c_img += 1
+                with timer.stage('nms'):
+                    boxes = boxes[:200]
+                    in_nms_boxes += len(boxes)
+                    _ = nms(boxes, classes, self.output_handler.suppress_threshold)
 
             if self.print_each_run:
-                self.print_stats(times_model, times_pre_nms, times_nms, self.n_images)
+                self.print_stats(timer.totals['model'], timer.totals['pre_nms'], timer.totals['nms'],
+                                 self.n_images)
                 print("Mean number of boxes processed by nms: ",
                       "{:.2f}".format(in_nms_boxes / self.n_images))
-            run += 1
-
-            total_time_model += times_model
-            total_time_pre_nms += times_pre_nms
-            total_time_nms += times_nms
+            for stage, seconds in timer.totals.items():
+                total_timer.add(stage, seconds)
 
+        totals = total_timer.totals
         print("Final results:")
         print("--------------------------------------")
         print("--------------------------------------\n\n")
-        self.print_stats(total_time_model, total_time_pre_nms, total_time_nms,
-                         self.n_images * self.runs)
+        self.print_stats(totals['model'], totals['pre_nms'], totals['nms'], self.n_images * self.runs)
+        return totals['model'] / (self.n_images * self.runs)
 
-    def val_image_output(self):
+    def val_image_output(self, timer):
         with torch.no_grad():
             input_, _, image_info = next(self.valid_loader_iter)
-            start = time.time()
-            input_ = input_.to(self.device)
-            boxes, confs = self.model(input_)
-            boxes = boxes.squeeze().permute(1, 0)
-            confs = confs.squeeze().permute(1, 0)
-            last_model = time.time() - start
-            return (boxes, confs), image_info, last_model
+            with timer.stage('model'):
+                input_ = input_.to(self.device)
+                boxes, confs = to_anchor_major(self.backend(input_), self.params)
+                boxes, confs = boxes[0], confs[0]
+            return (boxes, confs), image_info
 
     def print_stats(self, total_model, total_pre_nms, total_nms, avg_factor):
         print("Total time of model: ", "{:.4f}".format(total_model))
@@ -4,6 +4,8 @@ from torch.utils.data import DataLoader
 from data.dataset import CocoDetection
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler, SequentialSampler
 from general_config import constants, general_config
+from train import distributed
+from train.accumulation import loader_batch_size
 
 
 def get_dataloaders(params):
@@ -37,21 +39,34 @@ def get_dataloaders_test(params):
     return get_valid_dataloader(params)
 
 
-def get_train_dataloader(params):
+def get_train_dataloader(params, augmentation=True):
+    """
+    augmentation - False gives the plain resized train images in a fixed order, eg for the feature cache
+    """
     train_annotations_path = constants.train_annotations_path
     train_dataset = CocoDetection(root=constants.train_images_folder,
                                   annFile=train_annotations_path,
-                                  augmentation=True,
+                                  augmentation=augmentation,
                                   params=params)
 
     with open(train_annotations_path) as json_file:
         data = json.load(json_file)
         nr_images_in_train = len(data['images'])
 
+    indices = [i for i in range(nr_images_in_train)]
+    if not augmentation:
+        sampler = BatchSampler(SequentialSampler(indices),
+                               batch_size=params.batch_size, drop_last=False)
+    elif distributed.is_distributed():
+        sampler = distributed.DistributedBatchSampler(indices, batch_size=loader_batch_size(params),
+                                                      shuffle=True, drop_last=True)
+    else:
+        sampler = BatchSampler(SubsetRandomSampler(indices),
+                               batch_size=loader_batch_size(params), drop_last=True)
+
     return DataLoader(train_dataset, batch_size=None,
                       shuffle=False, num_workers=general_config.num_workers,
-                      sampler=BatchSampler(SubsetRandomSampler([i for i in range(nr_images_in_train)]),
-                                           batch_size=params.batch_size, drop_last=True))
+                      sampler=sampler)
 
 
 def get_valid_dataloader(params):
@@ -65,7 +80,14 @@ def get_valid_dataloader(params):
         data = json.load(json_file)
         nr_images_in_val = len(data['images'])
 
+    indices = [i for i in range(nr_images_in_val)]
+    if distributed.is_distributed():
+        sampler = distributed.DistributedBatchSampler(indices, batch_size=params.batch_size,
+                                                      shuffle=False, drop_last=False, pad=False)
+    else:
+        sampler = BatchSampler(SequentialSampler(indices),
+                               batch_size=params.batch_size, drop_last=False)
+
     return DataLoader(validation_dataset, batch_size=None,
                       shuffle=False, num_workers=general_config.num_workers,
-                      sampler=BatchSampler(SequentialSampler([i for i in range(nr_images_in_val)]),
-                                           batch_size=params.batch_size, drop_last=False))
+                      sampler=sampler)
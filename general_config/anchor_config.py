@@ -39,14 +39,31 @@ model_to_anchors = {
     constants.ssdlite: ssd_classic_19_19
 }
 
+
+def get_default_boxes(model_id):
+    """
+    anchors of any model_id, not only of the one currently configured
+    """
+    fig_size, feat_size, steps, scales, aspect_ratios, only_vertical = model_to_anchors[model_id].values()
+    return DefaultBoxes(fig_size, feat_size, steps,
+                        scales, aspect_ratios, only_vertical=only_vertical)
+
+
+def get_k_list(model_id):
+    """
+    number of anchors per feature map cell, for each feature map of model_id
+    """
+    _, _, _, _, aspect_ratios, only_vertical = model_to_anchors[model_id].values()
+    if only_vertical:
+        return [len(aspect_ratio) + 2 for aspect_ratio in aspect_ratios]
+    return [len(aspect_ratio)*2 + 2 for aspect_ratio in aspect_ratios]
+
+
 fig_size, feat_size, steps, scales, aspect_ratios, only_vertical = model_to_anchors[model_id].values()
 
-default_boxes = DefaultBoxes(fig_size, feat_size, steps,
-                             scales, aspect_ratios, only_vertical=only_vertical)
+default_boxes = get_default_boxes(model_id)
 
-k_list = [len(aspect_ratio)*2 + 2 for aspect_ratio in aspect_ratios]
-if only_vertical:
-    k_list = [len(aspect_ratio) + 2 for aspect_ratio in aspect_ratios]
+k_list = get_k_list(model_id)
 
 total_anchors = 0
 for (size, k) in zip(feat_size, k_list):
@@ -15,6 +15,14 @@ params_path = 'misc/experiments/{}/params.json'
 stats_path = 'misc/experiments/{}/stats.json'
 model_path = 'misc/experiments/{}/model_checkpoint'
 model_path_loss = 'misc/experiments/{}/model_checkpoint_loss'
+model_path_qat = 'misc/experiments/{}/model_checkpoint_qat'
+model_path_qat_loss = 'misc/experiments/{}/model_checkpoint_qat_loss'
+exported_model_path = 'misc/experiments/{}/model_scripted.pt'
+onnx_model_path = 'misc/experiments/{}/model.onnx'
+# written by the onnx backends of Custom_Infernce, kept apart from the exported onnx_model_path
+onnx_backend_model_path = 'misc/experiments/{}/model_backend.onnx'
+quantized_model_path = 'misc/experiments/{}/model_int8.pt'
+feature_cache_path = 'misc/experiments/{}/feature_cache'
 
 poly_lr = "poly"
 retina_lr = "retina"
@@ -8,3 +8,43 @@ batch_stats_step = 10
 eval_step = 1
 agnostic_nms = True
 num_workers = 0
+# backend used for distributed training, gloo also runs on CPU-only machines
+dist_backend = "gloo"
+# int8 kernels: fbgemm for x86 CPUs, qnnpack for ARM
+quantized_engine = "fbgemm"
+# cpu inference execution profile, see custom_inference/execution_profile.py
+channels_last = False
+inference_mode = True
+bf16_autocast = False
+# merge the loc and conf heads of each feature map for eager torch inference (architectures/fusion.fuse_heads),
+# fewer kernel launches but twice the multiply-adds of the point wise convs of the SSDLite heads, only
+# turn it on if python -m custom_inference.profile_benchmark shows it is faster on the target
+fuse_heads = False
+# torch.compile the model of the torch inference backend (pytorch >= 2.0)
+compile_inference = False
+# devices the served requests can ask for (the device form field), others get HTTP 400
+serving_devices = ['cpu'] + ['cuda:{}'.format(idx) for idx in range(torch.cuda.device_count())]
+# largest accepted request body of the servers (HTTP 413 above)
+max_upload_bytes = 16 * 1024 * 1024
+# dynamic batching of the served requests, see custom_inference/batching.py
+max_batch_size = 8
+max_batch_wait_ms = 5
+# images of a /process_images request in flight (decoding or waiting for the engine), at least
+# max_batch_size so they can fill a batch
+decode_threads = 8
+# zip / tar uploads of a /process_images request: images and uncompressed bytes, per image and in total
+archive_max_members = 1000
+archive_max_member_bytes = 32 * 1024 * 1024
+archive_max_total_bytes = 256 * 1024 * 1024
+# requests waiting for the model, more are rejected (HTTP 503)
+max_queue_size = 64
+# run_asgi.py executors: decode threads (or processes if decode_processes > 0) and the decodes
+# allowed to wait for them, more are rejected (HTTP 503)
+asgi_decode_threads = 4
+asgi_decode_processes = 0
+asgi_max_pending_decodes = 32
+# detections cache of the served images, see custom_inference/result_cache.py, 0 entries disables it
+result_cache_entries = 1024
+result_cache_ttl = 60
+# served requests latency target, caps the queue depth of the batching engine
+latency_slo_ms = 200
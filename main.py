@@ -2,8 +2,11 @@ from torch.utils.tensorboard import SummaryWriter
 from train.loss_fn import Detection_Loss
 import torch
 import random
+import os
 
-from train import train
+from train import train, distributed, accumulation
+from train.batch_size_finder import auto_batch_size
+from train.feature_cache import Feature_Cache, get_cached_dataloader
 from train.params import Params
 from train.validate import Model_evaluator
 from misc import cross_validation
@@ -23,7 +26,8 @@ except ImportError:
 
 
 def run(train_model=True, load_checkpoint=False, cross_validate=False,
-        validate=False, mixed_precision=False, test_dev=False):
+        validate=False, mixed_precision=False, test_dev=False, distributed_training=False,
+        find_batch_size=False, cache_features=False):
     """
     Arguments:
     train_model - train model
@@ -32,9 +36,17 @@ def run(train_model=True, load_checkpoint=False, cross_validate=False,
     cross_validate - cross validate for best nms thresold and positive confidence
     mixed_precision - use mixed_precision training
     test_dev - run model on coco test-dev set
+    distributed_training - data parallel training over all processes of the torch.distributed
+    group (one process per device, started with torchrun), see train/distributed.py
+    find_batch_size - probe the largest micro batch that fits in memory and accumulate gradients
+    up to the batch_size of params.json
+    cache_features - with a frozen backbone (ssdlite models), run it once over the train set and
+    train only the heads from the stored features, see train/feature_cache.py
     """
+    if distributed_training:
+        distributed.init_distributed()
     torch.manual_seed(2)
-    random.seed(2)
+    random.seed(2 + distributed.get_rank())
 
     params = Params(constants.params_path.format(general_config.model_id))
     stats = Params(constants.stats_path.format(general_config.model_id))
@@ -52,6 +64,7 @@ def run(train_model=True, load_checkpoint=False, cross_validate=False,
     if load_checkpoint:
         model, optimizer, start_epoch = training.load_model(model, params, optimizer)
     prints.print_trained_parameters_count(model, optimizer)
+    model = distributed.wrap_model(model, params)
 
     if test_dev:
         print("Running evaluation on test-dev")
@@ -64,7 +77,22 @@ def run(train_model=True, load_checkpoint=False, cross_validate=False,
     # tensorboard
     writer = SummaryWriter(filename_suffix=general_config.model_id)
 
-    if train_model:
+    if find_batch_size:
+        params.micro_batch_size = auto_batch_size(model, Detection_Loss(params), params)
+
+    if train_model and cache_features:
+        if not params.freeze_backbone or general_config.model_id == constants.ssd:
+            raise ValueError("The feature cache needs a frozen MobileNetV2 backbone")
+        if distributed_training:
+            raise ValueError("Training from the feature cache runs in a single process")
+        feature_cache = Feature_Cache(constants.feature_cache_path.format(general_config.model_id))
+        if not feature_cache.is_valid(model, params):
+            feature_cache.build(model, dataloaders.get_train_dataloader(params, augmentation=False),
+                                params)
+        train_loader = get_cached_dataloader(feature_cache, params)
+        valid_loader = dataloaders.get_valid_dataloader(params)
+        prints.print_dataset_stats(train_loader, valid_loader)
+    elif train_model:
         train_loader, valid_loader = training.prepare_datasets(params)
         prints.print_dataset_stats(train_loader, valid_loader)
     else:
@@ -74,7 +102,8 @@ def run(train_model=True, load_checkpoint=False, cross_validate=False,
     model_evaluator = Model_evaluator(valid_loader, detection_loss,
                                       params=params, stats=stats)
     if train_model:
-        lr_decay_policy = training.lr_decay_policy_setup(params, optimizer, len(train_loader))
+        lr_decay_policy = training.lr_decay_policy_setup(
+            params, optimizer, accumulation.steps_per_epoch(train_loader, params))
 
     if validate:
         print("Checkpoint epoch: ", start_epoch)
@@ -88,8 +117,9 @@ def run(train_model=True, load_checkpoint=False, cross_validate=False,
     if train_model:
         train.train(model, optimizer, train_loader, model_evaluator,
                     detection_loss, params, writer, lr_decay_policy, start_epoch,
-                    APEX_AVAILABLE and mixed_precision)
+                    APEX_AVAILABLE and mixed_precision, from_cache=cache_features)
 
 
 if __name__ == '__main__':
-    run()
+    # torchrun sets WORLD_SIZE for every process it starts
+    run(distributed_training=int(os.environ.get("WORLD_SIZE", 1)) > 1)
@@ -72,12 +72,13 @@ class Model_output_handler():
 
         return prediction_bboxes, predicted_classes, highest_confidence_for_predictions, high_confidence_indeces
 
-    def _predictions_over_threshold(self, prediction_bboxes, predicted_confidences):
+    def _predictions_over_threshold(self, prediction_bboxes, predicted_confidences, threshold=None):
         """
-        keep predictions above a confidence threshold
+        keep predictions above a confidence threshold, self.confidence_threshold if not given
         """
+        threshold = self.confidence_threshold if threshold is None else threshold
         highest_confidence = np.amax(predicted_confidences, axis=1)
-        keep_indices = (highest_confidence > self.confidence_threshold)
+        keep_indices = (highest_confidence > threshold)
 
         prediction_bboxes = prediction_bboxes[keep_indices]
         predicted_confidences = predicted_confidences[keep_indices]
@@ -110,14 +111,13 @@ class Model_output_handler():
         """
         Computes offsets according to the ssd paper formula
         """
-        prediction_bboxes = prediction_bboxes.cpu()
+        # out of place: the model outputs can be inference mode tensors, see Execution_Profile
+        prediction_bboxes = prediction_bboxes.cpu().float()
 
-        prediction_bboxes[:, :2] = (1/self.scale_xy)*prediction_bboxes[:, :2]
-        prediction_bboxes[:, 2:] = (1/self.scale_wh)*prediction_bboxes[:, 2:]
-
-        prediction_bboxes[:, :2] = prediction_bboxes[:, :2] * self.anchors_xywh[:, 2:] + \
+        xy = (1/self.scale_xy)*prediction_bboxes[:, :2] * self.anchors_xywh[:, 2:] + \
             self.anchors_xywh[:, :2]
-        prediction_bboxes[:, 2:] = prediction_bboxes[:, 2:].exp() * self.anchors_xywh[:, 2:]
+        wh = ((1/self.scale_wh)*prediction_bboxes[:, 2:]).exp() * self.anchors_xywh[:, 2:]
+        prediction_bboxes = torch.cat([xy, wh], dim=1)
 
         return self._rescale_bboxes(prediction_bboxes, size)
 
@@ -6,6 +6,7 @@ from general_config import anchor_config, constants, classes_config, general_con
 from data import dataloaders
 from visualize import anchor_mapping
 from utils.training import load_weigths_only, model_setup
+from utils.box_computations import to_anchor_major
 from general_config.general_config import device
 
 
@@ -31,11 +32,11 @@ def model_output_pipeline(model_outputs=True, visualize_anchors=False,
         for batch_idx, (batch_images, batch_targets, images_info) in enumerate(valid_loader):
             if model_outputs:
                 batch_images = batch_images.to(device)
-                predictions = model(batch_images)
+                predictions = to_anchor_major(model(batch_images), params)
             else:
                 n_classes = len(classes_config.training_ids)
-                predictions = [torch.randn(params.batch_size, 4, anchor_config.total_anchors),
-                               torch.randn(params.batch_size, n_classes, anchor_config.total_anchors)]
+                predictions = [torch.randn(params.batch_size, anchor_config.total_anchors, 4),
+                               torch.randn(params.batch_size, anchor_config.total_anchors, n_classes)]
 
             for idx in range(len(batch_images)):
                 non_background = batch_targets[1][idx] != 100
@@ -44,8 +45,8 @@ def model_output_pipeline(model_outputs=True, visualize_anchors=False,
                 gt_class = batch_targets[1][idx][non_background]
 
                 iou, maps = anchor_mapping.test_anchor_mapping(
-                    image=batch_images[idx], bbox_predictions=predictions[0][idx].permute(1, 0),
-                    classification_predictions=predictions[1][idx].permute(1, 0),
+                    image=batch_images[idx], bbox_predictions=predictions[0][idx],
+                    classification_predictions=predictions[1][idx],
                     gt_bbox=gt_bbox, gt_class=gt_class, image_info=images_info[idx], params=params,
                     model_outputs=model_outputs, visualize_anchors=visualize_anchors,
                     visualize_anchor_gt_pair=visualize_anchor_gt_pair, all_anchor_classes=all_anchor_classes,
@@ -0,0 +1,264 @@
+import asyncio
+import argparse
+import functools
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from custom_inference import run
+from custom_inference.batching import Batching_Engine, Queue_Full, Deadline_Exceeded, Bad_Admission, \
+    parse_admission
+from custom_inference.batch_processing import decode_resized, Undecodable_Image
+from custom_inference.result_cache import Result_Cache, cache_key, RETRY
+from custom_inference import serialization
+from general_config import general_config
+from utils import metrics
+from utils.metrics import timed
+from utils.box_computations import corners_to_wh
+
+try:
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.responses import JSONResponse, Response
+    from starlette.routing import Route
+    ASGI_AVAILABLE = True
+except ImportError:
+    ASGI_AVAILABLE = False
+
+"""
+Async serving front end, same /process_image contract as run_flask.py
+
+The uploads are read on the event loop, the decoding (and resizing) runs in a bounded thread or
+process pool, the preprocessing in a thread pool and the model behind the Batching_Engine, so a slow client only holds its own
+coroutine. Both stages have a bounded queue: when asgi_max_pending_decodes decodes are in flight
+or max_queue_size requests wait for the model, new requests get HTTP 503 right away. Request
+bodies over general_config.max_upload_bytes get HTTP 413 before they are buffered
+
+Needs starlette, python-multipart and uvicorn: pip install starlette python-multipart uvicorn
+Usage: python run_asgi.py [--host 127.0.0.1] [--port 5000]
+"""
+
+ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'])
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def error_response(message, status_code):
+    return JSONResponse({'message': message}, status_code=status_code)
+
+
+class Body_Too_Large(Exception):
+    pass
+
+
+class Body_Limit():
+    """
+    ASGI middleware answering 413 to request bodies over max_bytes, the same limit as the
+    MAX_CONTENT_LENGTH of run_flask.py: checked on the Content-Length header before anything is
+    read, and on the received bytes for streamed (chunked) bodies, before the form is buffered
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        too_large = error_response('The request body is larger than {} bytes'.format(self.max_bytes), 413)
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await too_large(scope, receive, send)
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    raise Body_Too_Large()
+            return message
+
+        async def tracking_send(message):
+            nonlocal started
+            started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except Body_Too_Large:
+            if started:
+                raise
+            await too_large(scope, receive, send)
+
+
+class Inference_Server():
+    def __init__(self, inferer, engine):
+        self.inferer = inferer
+        self.engine = engine
+        if general_config.asgi_decode_processes:
+            # spawned, not forked: by now the engine thread, the torch thread pools and the event loop
+            # exist, a forked child could inherit one of their locks held
+            self.decode_executor = ProcessPoolExecutor(general_config.asgi_decode_processes,
+                                                       mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.decode_executor = ThreadPoolExecutor(general_config.asgi_decode_threads)
+        # Batching_Engine.submit preprocesses (tensor conversion, normalization) in the calling thread
+        if isinstance(self.decode_executor, ThreadPoolExecutor):
+            self.submit_executor = self.decode_executor
+        else:
+            self.submit_executor = ThreadPoolExecutor(general_config.asgi_decode_threads)
+        self.max_pending_decodes = general_config.asgi_max_pending_decodes
+        self.pending_decodes = 0
+        self.result_cache = None
+        if general_config.result_cache_entries:
+            self.result_cache = Result_Cache(general_config.result_cache_entries,
+                                             general_config.result_cache_ttl)
+
+    async def decode(self, data):
+        """
+        resized image and original (width, height), None if data is not an image
+        raises Queue_Full if too many decodes are in flight
+        """
+        # no lock needed, the counter is only touched from the event loop
+        if self.pending_decodes >= self.max_pending_decodes:
+            raise Queue_Full("{} decodes in flight".format(self.pending_decodes))
+        self.pending_decodes += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # includes the wait for a free decoder
+            with timed('decode'):
+                return await loop.run_in_executor(self.decode_executor, decode_resized, data,
+                                                  self.inferer.params.input_width,
+                                                  self.inferer.params.input_height)
+        finally:
+            self.pending_decodes -= 1
+
+    async def detect(self, data, settings, deadline=None, priority=None):
+        """
+        (x1, y1, x2, y2) boxes of the image bytes, identical concurrent requests share one inference
+        deadline, priority - see parse_admission of custom_inference/batching.py
+        """
+        async def compute():
+            decoded = await self.decode(data)
+            if decoded is None:
+                raise Undecodable_Image()
+            image, size = decoded
+            # off the event loop, submit raises Queue_Full right away if the request is not admitted
+            loop = asyncio.get_running_loop()
+            future = await loop.run_in_executor(self.submit_executor, functools.partial(
+                self.engine.submit, image, settings, size, deadline, priority))
+            return await asyncio.wrap_future(future)
+
+        if self.result_cache is None:
+            return await compute()
+        key = cache_key(data, general_config.model_id, settings)
+        while True:
+            future, owner = self.result_cache.lookup(key)
+            if owner:
+                break
+            boxes = await asyncio.wrap_future(future)
+            if boxes is not RETRY:
+                return boxes
+        try:
+            boxes = await compute()
+        except Queue_Full:
+            # rejected by its own deadline / priority, a waiting request retries as the owner
+            self.result_cache.release(key)
+            raise
+        except Exception as e:
+            self.result_cache.fail(key, e)
+            raise
+        self.result_cache.resolve(key, boxes)
+        return boxes.copy()
+
+    async def cache_stats(self, request):
+        if self.result_cache is None:
+            return error_response('The result cache is disabled', 200)
+        return JSONResponse(self.result_cache.snapshot())
+
+    async def metrics(self, request):
+        return Response(metrics.REGISTRY.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+    async def process_image(self, request):
+        response = await self.handle_image(request)
+        metrics.REQUESTS.inc(endpoint='process_image', code=response.status_code)
+        return response
+
+    async def handle_image(self, request):
+        form = await request.form()
+        files = form.getlist('files[]')
+        if not files:
+            return error_response('No file part in the request', 400)
+
+        file = files[0]
+        if not allowed_file(file.filename):
+            return JSONResponse({file.filename: 'File type is not allowed'}, status_code=400)
+        try:
+            device = run.serving_device(form['device'])
+        except run.Bad_Device as e:
+            return error_response(str(e), 400)
+        settings = self.inferer.make_settings((float(form['nms_thresh']), float(form['conf_thresh']),
+                                               device))
+        try:
+            deadline, priority = parse_admission(request.headers.get('x-deadline-ms', form.get('deadline_ms')),
+                                                 request.headers.get('x-priority', form.get('priority')))
+        except Bad_Admission as e:
+            return error_response(str(e), 400)
+        with timed('upload_read'):
+            data = await file.read()
+
+        start = time.time()
+        try:
+            boxes = await self.detect(data, settings, deadline, priority)
+        except Undecodable_Image:
+            return JSONResponse({file.filename: 'Could not decode the image'}, status_code=400)
+        except Deadline_Exceeded:
+            return error_response('The deadline can not be met, retry later', 503)
+        except Queue_Full:
+            return error_response('Server overloaded, retry later', 503)
+        total = time.time() - start
+
+        mimetype = serialization.negotiate(request.headers.get('accept'))
+        with timed('serialization'):
+            body = serialization.encode(corners_to_wh(boxes), total, mimetype)
+        return Response(body, status_code=201, media_type=mimetype)
+
+    def shutdown(self):
+        self.engine.stop()
+        self.decode_executor.shutdown()
+        if self.submit_executor is not self.decode_executor:
+            self.submit_executor.shutdown()
+
+
+def create_app():
+    if not ASGI_AVAILABLE:
+        raise ImportError("Please install starlette, python-multipart and uvicorn to use run_asgi.py")
+    inferer = run.Custom_Infernce()
+    server = Inference_Server(inferer, Batching_Engine(inferer))
+    metrics.MODEL_INFO.set(1, model_id=general_config.model_id, device=inferer.device,
+                           backend=inferer.backend_name)
+    return Starlette(routes=[Route('/process_image', server.process_image, methods=['POST']),
+                             Route('/cache_stats', server.cache_stats),
+                             Route('/metrics', server.metrics)],
+                     middleware=[Middleware(CORSMiddleware, allow_origins=['*'],
+                                            allow_methods=['*'], allow_headers=['*']),
+                                 Middleware(Body_Limit, max_bytes=general_config.max_upload_bytes)],
+                     on_shutdown=[server.shutdown])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Async inference server")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    # a single server process, the model parallelism comes from the batching engine
+    uvicorn.run(create_app(), host=args.host, port=args.port, workers=1)
@@ -1,28 +1,79 @@
-from flask import request, render_template, jsonify
+from flask import request, render_template, jsonify, Response
 from flask import Flask
 from flask_cors import CORS
-import numpy as np
-import cv2
 from custom_inference import run
-import json
+from custom_inference.batching import Batching_Engine, Queue_Full, Deadline_Exceeded, Bad_Admission, \
+    parse_admission
+from custom_inference.batch_processing import collect_uploads, process_images, decode_reduced, \
+    Undecodable_Image
+from custom_inference import serialization
+from custom_inference.result_cache import Result_Cache, cache_key
+from general_config import general_config
+from utils import metrics
+from utils.metrics import timed, Stage_Timer
 from utils.box_computations import corners_to_wh
 import time
+import threading
 
 ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'])
-inferer = run.Custom_Infernce()
+# created on first use (or by init_inference), so a pre-forking supervisor can import this module
+# and load the model only once, see serve_prefork.py
+inferer, engine, result_cache = None, None, None
+init_lock = threading.Lock()
+# set by serve_prefork.py: returns (ready workers, total workers)
+readiness_probe = None
 
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return json.JSONEncoder.default(self, obj)
+def init_inference(custom_inferer=None):
+    """
+    custom_inferer - an already loaded Custom_Infernce, a new one is made otherwise
+    the batching engine thread is started here, in the serving process
+    """
+    global inferer, engine, result_cache
+    with init_lock:
+        if engine is None:
+            inferer = custom_inferer or run.Custom_Infernce()
+            # concurrent requests share the forward passes
+            engine = Batching_Engine(inferer)
+            metrics.MODEL_INFO.set(1, model_id=general_config.model_id, device=inferer.device,
+                                   backend=inferer.backend_name)
+            if general_config.result_cache_entries:
+                result_cache = Result_Cache(general_config.result_cache_entries,
+                                            general_config.result_cache_ttl)
+    return engine
+
+
+def detect(data, settings, deadline=None, priority=None, timer=None):
+    """
+    (x1, y1, x2, y2) boxes of the uploaded image bytes, from the result cache if the same image
+    was just processed with the same settings
+    deadline, priority - see parse_admission of custom_inference/batching.py
+    timer - Stage_Timer of the request, gets the decode, preprocess, forward and postprocess durations
+    """
+    engine = init_inference()
+    request_timer = timer or Stage_Timer()
+
+    def compute():
+        # large jpegs are decoded at a reduced resolution, the boxes are mapped back to size
+        with timed('decode'), request_timer.stage('decode'):
+            decoded = decode_reduced(data, inferer.params.input_width, inferer.params.input_height)
+        if decoded is None:
+            raise Undecodable_Image()
+        image, size = decoded
+        return engine.infer(image, settings, size=size, deadline=deadline, priority=priority,
+                            timer=timer)
+
+    if result_cache is None:
+        return compute()
+    # an admission rejection only concerns this request, the coalesced ones retry on their own
+    return result_cache.get_or_compute(cache_key(data, general_config.model_id, settings), compute,
+                                       retry_on=(Queue_Full,))
 
 
 app = Flask(__name__)
 CORS(app)
 app.secret_key = "secret key"
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = general_config.max_upload_bytes
 
 
 def allowed_file(filename):
@@ -51,19 +102,41 @@ def upload_file():
 
     file = files[0]
     if file and allowed_file(file.filename):
-        filestr = file.read()
-        npimg = np.fromstring(filestr, np.uint8)
-        img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+        with timed('upload_read'):
+            filestr = file.read()
+        init_inference()
+        try:
+            settings = inferer.make_settings((nms_thresh, conf, run.serving_device(device)))
+        except run.Bad_Device as e:
+            resp = jsonify({'message': str(e)})
+            resp.status_code = 400
+            return resp
+        try:
+            deadline, priority = parse_admission(
+                request.headers.get('X-Deadline-Ms', request.form.get('deadline_ms')),
+                request.headers.get('X-Priority', request.form.get('priority')))
+        except Bad_Admission as e:
+            resp = jsonify({'message': str(e)})
+            resp.status_code = 400
+            return resp
 
         start = time.time()
-        boxes = inferer.run_inference(img, modify_image=False,
-                                      custom_settings=(nms_thresh, conf, device))
+        try:
+            boxes = detect(filestr, settings, deadline, priority)
+        except Undecodable_Image:
+            resp = jsonify({file.filename: 'Could not decode the image'})
+            resp.status_code = 400
+            return resp
+        except Deadline_Exceeded:
+            resp = jsonify({'message': 'The deadline can not be met, retry later'})
+            resp.status_code = 503
+            return resp
+        except Queue_Full:
+            resp = jsonify({'message': 'Server overloaded, retry later'})
+            resp.status_code = 503
+            return resp
         boxes = corners_to_wh(boxes)
         total = time.time() - start
-        total = "{:.3f}".format(total)
-
-        json_dump = json.dumps({'boxes': boxes}, cls=NumpyEncoder)
-        boxes = json.loads(json_dump)
 
         success = True
     else:
@@ -75,14 +148,126 @@ def upload_file():
         resp.status_code = 206
         return resp
     if success:
-        resp = jsonify({'data': boxes, 'time_taken': total})
-        resp.status_code = 201
-        return resp
+        # json or the compact binary layout, see custom_inference/serialization.py
+        mimetype = serialization.negotiate(request.headers.get('Accept'))
+        with timed('serialization'):
+            body = serialization.encode(boxes, total, mimetype)
+        return Response(body, status=201, mimetype=mimetype)
     else:
         resp = jsonify(errors)
         resp.status_code = 400
         return resp
 
 
+@app.route('/process_images', methods=['POST'])
+def upload_files():
+    """
+    every uploaded image (or image of an uploaded zip / tar archive) is processed, through the
+    batching engine, the priority defaults to bulk
+    """
+    if 'files[]' not in request.files:
+        resp = jsonify({'message': 'No file part in the request'})
+        resp.status_code = 400
+        return resp
+
+    init_inference()
+    try:
+        device = run.serving_device(request.form['device'])
+    except run.Bad_Device as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 400
+        return resp
+    settings = inferer.make_settings((float(request.form['nms_thresh']), float(request.form['conf_thresh']),
+                                      device))
+    try:
+        deadline, priority = parse_admission(
+            request.headers.get('X-Deadline-Ms', request.form.get('deadline_ms')),
+            request.headers.get('X-Priority', request.form.get('priority', 'bulk')))
+    except Bad_Admission as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 400
+        return resp
+
+    start = time.time()
+    with timed('upload_read'):
+        uploads = [(file.filename, file.read()) for file in request.files.getlist('files[]') if file]
+    images, errors, too_large = collect_uploads(uploads)
+    read_time = time.time() - start
+
+    # decode, preprocess and postprocess are summed over the images, forward over the forward passes
+    timer = Stage_Timer()
+    try:
+        results, failed = process_images(lambda data: detect(data, settings, deadline, priority, timer),
+                                         images)
+    except Deadline_Exceeded:
+        resp = jsonify({'message': 'The deadline can not be met, retry later'})
+        resp.status_code = 503
+        return resp
+    except Queue_Full:
+        resp = jsonify({'message': 'Server overloaded, retry later'})
+        resp.status_code = 503
+        return resp
+    for name in failed:
+        errors[name] = 'Could not decode the image'
+
+    data = [{'filename': name, 'boxes': corners_to_wh(boxes).tolist()} for name, boxes in results]
+    timings = dict({'decode': 0, 'preprocess': 0, 'forward': 0, 'postprocess': 0}, **timer.totals)
+    timings['read'] = read_time
+    time_taken = {stage: "{:.3f}".format(seconds) for stage, seconds in timings.items()}
+
+    if data and errors:
+        resp = jsonify({'data': data, 'errors': errors, 'time_taken': time_taken,
+                        'message': 'File(s) partially processed'})
+        resp.status_code = 206
+        return resp
+    if data:
+        resp = jsonify({'data': data, 'time_taken': time_taken})
+        resp.status_code = 201
+        return resp
+    resp = jsonify(errors or {'message': 'No images in the request'})
+    resp.status_code = 413 if too_large else 400
+    return resp
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """
+    hits, misses, coalesced requests, evictions and size of the result cache
+    """
+    if result_cache is None:
+        return jsonify({'message': 'The result cache is disabled'})
+    return jsonify(result_cache.snapshot())
+
+
+@app.after_request
+def count_request(response):
+    metrics.REQUESTS.inc(endpoint=request.endpoint or 'unknown', code=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    latency histograms per stage, queue depth, batch sizes, requests by status code, in the
+    Prometheus text format (per process, every pre-forked worker has its own)
+    """
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route('/health')
+def health():
+    """
+    readiness probe: 200 once the model is loaded (and, pre-forked, every worker warmed up)
+    """
+    if readiness_probe is not None:
+        ready, total = readiness_probe()
+    else:
+        ready, total = int(engine is not None), 1
+    resp = jsonify({'ready_workers': ready, 'workers': total})
+    resp.status_code = 200 if ready == total else 503
+    return resp
+
+
 if __name__ == "__main__":
-    app.run()
+    init_inference()
+    app.run(threaded=True)
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import multiprocessing
+
+import numpy as np
+import torch
+from werkzeug.serving import make_server
+
+import run_flask
+from custom_inference import run, backends
+
+"""
+Pre-forked serving of run_flask.app on cpu
+
+The supervisor loads the model once, moves its weights to shared memory and opens the listening
+socket, then forks the workers. Each worker gets the same weights (no copy, no checkpoint load),
+its own intra-op thread count and a fixed set of cores, warms up and accepts connections on the
+shared socket, the kernel spreads the connections among the workers. Dead workers are re-forked.
+
+GET /health, on any worker, answers 200 once every worker has warmed up, 503 before
+
+Linux only (fork, sched_setaffinity)
+Usage: python serve_prefork.py [--workers 4] [--threads_per_worker 2] [--host 127.0.0.1] [--port 5000]
+"""
+
+
+class Prefork_Supervisor():
+    def __init__(self, n_workers, threads_per_worker, host, port):
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.host = host
+        self.port = port
+        # workers set their slot once warmed up, read by every worker for /health
+        self.ready = multiprocessing.Array('b', n_workers, lock=False)
+        self.workers = {}
+        self.stopping = False
+
+    def load_model(self):
+        # the OpenMP thread pool must not exist at fork time, the parent runs single threaded
+        torch.set_num_threads(1)
+        self.inferer = run.Custom_Infernce()
+        if self.inferer.backend_name != backends.TORCH or torch.device(self.inferer.device).type != "cpu":
+            raise ValueError("Pre-forked serving needs the torch backend on cpu")
+        self.inferer.model.share_memory()
+
+    def open_socket(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        self.socket.set_inheritable(True)
+
+    def worker_cores(self, idx):
+        cores = sorted(os.sched_getaffinity(0))
+        start = (idx * self.threads_per_worker) % len(cores)
+        return {cores[(start + offset) % len(cores)] for offset in range(self.threads_per_worker)}
+
+    def readiness(self):
+        return sum(self.ready), self.n_workers
+
+    def run_worker(self, idx):
+        """
+        body of a forked worker, never returns
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.sched_setaffinity(0, self.worker_cores(idx))
+        torch.set_num_threads(self.threads_per_worker)
+
+        run_flask.readiness_probe = self.readiness
+        engine = run_flask.init_inference(self.inferer)
+        params = self.inferer.params
+        dummy = np.zeros((params.input_height, params.input_width, 3), dtype=np.uint8)
+        for _ in range(3):
+            engine.infer(dummy)
+        self.ready[idx] = 1
+        print("Worker {} (pid {}) ready on cores {}".format(idx, os.getpid(), sorted(self.worker_cores(idx))))
+
+        server = make_server(self.host, self.port, run_flask.app, threaded=True, fd=self.socket.fileno())
+        server.serve_forever()
+        os._exit(0)
+
+    def fork_worker(self, idx):
+        self.ready[idx] = 0
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run_worker(idx)
+            finally:
+                os._exit(1)
+        self.workers[pid] = idx
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def serve(self):
+        self.load_model()
+        self.open_socket()
+        for idx in range(self.n_workers):
+            self.fork_worker(idx)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print("Serving on {}:{} with {} workers".format(self.host, self.port, self.n_workers))
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            idx = self.workers.pop(pid, None)
+            if idx is None or self.stopping:
+                continue
+            print("Worker {} (pid {}) exited with status {}, restarting".format(idx, pid, status))
+            time.sleep(1)
+            self.fork_worker(idx)
+
+
+if __name__ == "__main__":
+    if not hasattr(os, 'fork') or not hasattr(os, 'sched_setaffinity'):
+        sys.exit("Pre-forked serving needs Linux")
+    parser = argparse.ArgumentParser(description="Pre-forked inference server")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="defaults to the available cores / threads_per_worker")
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    n_workers = args.workers or max(1, len(os.sched_getaffinity(0)) // args.threads_per_worker)
+    Prefork_Supervisor(n_workers, args.threads_per_worker, args.host, args.port).serve()
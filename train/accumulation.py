@@ -0,0 +1,53 @@
+"""
+Gradient accumulation helpers
+
+params.batch_size is the effective batch size of an optimizer step, params.micro_batch_size (if set)
+is the number of images that actually go through the model at once. The gradients of
+batch_size // micro_batch_size micro batches are accumulated before each optimizer step, so
+batch_size has to be a multiple of micro_batch_size.
+"""
+
+
+def accumulation_steps(params):
+    """
+    number of micro batches accumulated for one optimizer step
+    raises ValueError if batch_size is not a multiple of micro_batch_size: the optimizer batch
+    (and with it the learning rate / batch size relationship) would silently change
+    """
+    if not params.micro_batch_size or params.micro_batch_size >= params.batch_size:
+        return 1
+    if params.batch_size % params.micro_batch_size:
+        raise ValueError("batch_size ({}) must be a multiple of micro_batch_size ({}), the effective batch "
+                         "size would be {}".format(params.batch_size, params.micro_batch_size,
+                                                   params.batch_size // params.micro_batch_size
+                                                   * params.micro_batch_size))
+    return params.batch_size // params.micro_batch_size
+
+
+def loader_batch_size(params):
+    """
+    batch size the train data loader should provide
+    """
+    if accumulation_steps(params) == 1:
+        return params.batch_size
+    return params.micro_batch_size
+
+
+def steps_per_epoch(train_loader, params):
+    """
+    number of optimizer steps in an epoch, this is what the lr policies should count
+    """
+    return len(train_loader) // accumulation_steps(params)
+
+
+def accumulation_groups(data_loader, steps):
+    """
+    groups consecutive batches of the data loader in lists of size steps
+    an incomplete last group is dropped, similar to drop_last
+    """
+    group = []
+    for batch in data_loader:
+        group.append(batch)
+        if len(group) == steps:
+            yield group
+            group = []
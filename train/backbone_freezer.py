@@ -4,6 +4,10 @@ class Backbone_Freezer():
     """
     Handles the freezing/unfreezing of the backbone of the model dynamically during training
     works for MobileNetV2
+
+    Besides disabling the gradients of the frozen layers, the backbone is told where the frozen
+    prefix ends: that part of the forward is run under no_grad (and with eval mode batch norm if
+    params.frozen_bn_eval), so autograd only records the graph from the first trainable layer
     """
     def __init__(self, params, freeze_idx=19):
         self.params = params
@@ -13,15 +17,29 @@ class Backbone_Freezer():
         for params in model.backbone.parameters():
             params.requires_grad = False
 
+        if hasattr(model.backbone, 'features'):
+            model.backbone.frozen_bn_eval = bool(self.params.frozen_bn_eval)
+            self.set_frozen_prefix(model, len(model.backbone.features))
+
+    def set_frozen_prefix(self, model, layer_idx):
+        if hasattr(model.backbone, 'frozen_prefix'):
+            model.backbone.frozen_prefix = layer_idx
+            # refresh the batch norm modes of the layers that became trainable
+            model.backbone.train(model.backbone.training)
+
     def unfreeze_from(self, layer_idx, model):
         """
-        MobileNetV2 has 19 residual bottleneck layers
-        unfreezes layers from layer_idx to 18
+        MobileNetV2 has 19 residual bottleneck layers (18 for the modified SSDLite)
+        unfreezes layers from layer_idx to the last one
         """
-        for i in range(layer_idx, 19):
+        n_layers = len(model.backbone.features)
+        for i in range(layer_idx, n_layers):
             for parameters in model.backbone.features[i].parameters():
                 parameters.requires_grad = True
 
+        # gradient tracking starts at the first trainable layer
+        self.set_frozen_prefix(model, min(getattr(model.backbone, 'frozen_prefix', 0), layer_idx))
+
     def step(self, epoch, model):
         """
         uniformly unfreeze 15 layers from the start to the first decay
@@ -0,0 +1,189 @@
+import copy
+import time
+import torch
+
+from general_config import general_config, classes_config
+from general_config.anchor_config import default_boxes
+from train import distributed
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+
+def default_memory_budget():
+    """
+    memory budget in bytes: 90% of the gpu memory or 80% of the currently available RAM
+    """
+    device = general_config.device
+    if device.type == "cuda":
+        return int(torch.cuda.get_device_properties(device).total_memory * 0.9)
+    if not PSUTIL_AVAILABLE:
+        raise ImportError("psutil is needed to measure memory usage on cpu")
+    return int(psutil.virtual_memory().available * 0.8)
+
+
+def default_candidates(params):
+    """
+    powers of two up to the effective batch size, and the batch size itself
+    """
+    candidates, size = [], 1
+    while size < params.batch_size:
+        candidates.append(size)
+        size *= 2
+    candidates.append(params.batch_size)
+    return candidates
+
+
+def synthetic_batch(batch_size, params):
+    """
+    random images with some matched anchors, enough to exercise the full forward, loss and backward
+    """
+    input_ = torch.randn(batch_size, 3, params.input_height, params.input_width)
+
+    anchors_xywh = default_boxes(order="xywh")
+    gt_bbox = anchors_xywh.unsqueeze(dim=0).repeat(batch_size, 1, 1)
+    # 100 - background id, every 50th anchor is mapped to an object
+    gt_class = torch.full((batch_size, anchors_xywh.shape[0]), 100, dtype=torch.int)
+    gt_class[:, ::50] = classes_config.training_ids[0]
+
+    return input_, [gt_bbox, gt_class]
+
+
+class Memory_Meter():
+    """
+    measures the peak memory used by a training step, exact on gpu, approximated by the
+    growth of the process resident memory on cpu (the weights are already counted there)
+    """
+
+    def __init__(self):
+        self.device = general_config.device
+        self.baseline = 0
+        if self.device.type != "cuda":
+            if not PSUTIL_AVAILABLE:
+                raise ImportError("psutil is needed to measure memory usage on cpu")
+            self.process = psutil.Process()
+            self.baseline = self.process.memory_info().rss
+
+    def reset(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.peak = self.current()
+
+    def current(self):
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device)
+        return self.process.memory_info().rss - self.baseline
+
+    def sample(self):
+        self.peak = max(self.peak, self.current())
+        return self.peak
+
+
+def probe_step(model, detection_loss, input_, label, memory_meter):
+    """
+    forward + backward of one batch, returns the time taken and the peak memory
+    no optimizer step is made
+    """
+    device = general_config.device
+    start = time.time()
+    input_ = input_.to(device)
+    label = [label[0].to(device), label[1].to(device)]
+
+    model.zero_grad()
+    output = model(input_)
+    l_loss, c_loss = detection_loss.ssd_loss(output, label)
+    # activations are all alive at this point
+    memory_meter.sample()
+    (l_loss + c_loss).backward()
+    memory_meter.sample()
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.time() - start, memory_meter.peak
+
+
+def probe_candidates(model, detection_loss, params, memory_budget, candidates, n_iters):
+    """
+    returns the largest candidate whose training step fits in memory_budget, None if none fits
+    """
+    memory_meter = Memory_Meter()
+
+    initial_state = copy.deepcopy(model.state_dict())
+    model.train()
+
+    best_size = None
+    print("Memory budget: {:.0f} MB".format(memory_budget / 2**20))
+    for batch_size in candidates:
+        input_, label = synthetic_batch(batch_size, params)
+        try:
+            memory_meter.reset()
+            # warm up
+            probe_step(model, detection_loss, input_, label, memory_meter)
+
+            total_time = 0
+            for _ in range(n_iters):
+                step_time, peak = probe_step(model, detection_loss, input_, label, memory_meter)
+                total_time += step_time
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            print("Batch size {}: out of memory".format(batch_size))
+            if general_config.device.type == "cuda":
+                torch.cuda.empty_cache()
+            break
+
+        throughput = batch_size * n_iters / total_time
+        fits = peak <= memory_budget
+        print("Batch size {}: peak memory {:.0f} MB, {:.2f} images/s{}".format(
+            batch_size, peak / 2**20, throughput, "" if fits else " - over budget"))
+        if not fits:
+            break
+        best_size = batch_size
+
+    model.zero_grad()
+    model.load_state_dict(initial_state)
+    return best_size
+
+
+def auto_batch_size(model, detection_loss, params, memory_budget=None, candidates=None, n_iters=3):
+    """
+    Finds the largest micro batch size whose training step fits in the memory budget
+
+    Arguments:
+    model - model to probe, its weights and batch norm statistics are restored afterwards
+    detection_loss - Detection_Loss
+    memory_budget - bytes, see default_memory_budget
+    candidates - micro batch sizes to try, increasingly, see default_candidates
+    n_iters - timed iterations for each candidate (after one warm up iteration)
+
+    Prints the peak memory and the throughput of each candidate
+    Returns the largest fitting micro batch size that divides params.batch_size, to be used as
+    params.micro_batch_size
+    In distributed training only the first process probes, the others get its result, so all of
+    them accumulate the same number of micro batches
+    """
+    model = distributed.unwrap_model(model)
+    memory_budget = memory_budget or default_memory_budget()
+    candidates = candidates or default_candidates(params)
+
+    best_size = None
+    if distributed.is_main_process():
+        best_size = probe_candidates(model, detection_loss, params, memory_budget, candidates, n_iters)
+    # 0 for none fits, every process raises
+    best_size = int(distributed.broadcast_value(best_size or 0))
+
+    if not best_size:
+        raise RuntimeError("Not even a batch of {} images fits in the memory budget".format(candidates[0]))
+
+    print("Largest micro batch size that fits: ", best_size)
+    if best_size < params.batch_size:
+        # the accumulated micro batches have to add up to the batch size exactly
+        best_size = max(size for size in range(1, best_size + 1) if params.batch_size % size == 0)
+        print("Micro batch size dividing batch size {}: {}".format(params.batch_size, best_size))
+    print("Gradient accumulation steps for batch size {}: {}".format(
+        params.batch_size, max(params.batch_size // best_size, 1)))
+    return best_size
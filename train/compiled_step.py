@@ -0,0 +1,50 @@
+import torch
+
+"""
+Opt in torch.compile training step (params.compile)
+
+The model forward and Detection_Loss.ssd_loss are compiled as a single region, so the per feature
+map head loop, the offset encoding and the loss reductions are fused instead of launched as
+many small kernels. The backward pass is compiled along (AOTAutograd), the optimizer step stays eager
+
+Batch size handling (params.compile_dynamic):
+0 - static shapes, the graph is specialized on the batch size of the first step; batches of
+another size (the last, partial, batch of an epoch) run eager instead of triggering a recompilation
+1 - the batch dimension is dynamic, a single graph is compiled for every batch size
+"""
+
+
+class Loss_Step():
+    def __init__(self, model, detection_loss, params):
+        if not hasattr(torch, 'compile'):
+            raise ValueError("params.compile needs torch.compile (pytorch >= 2.0)")
+        self.model = model
+        self.detection_loss = detection_loss
+        self.dynamic = bool(params.compile_dynamic)
+        self.static_batch_size = None
+        self.compiled = torch.compile(self.forward_loss, dynamic=self.dynamic)
+
+    def forward_loss(self, input_, gt_bbox, gt_id, reduction='mean'):
+        output = self.model(input_)
+        return self.detection_loss.ssd_loss(output, [gt_bbox, gt_id], reduction=reduction)
+
+    def __call__(self, input_, label, reduction='mean'):
+        """
+        returns the localization and classification loss of the batch, as Detection_Loss.ssd_loss
+        """
+        if not self.dynamic:
+            if self.static_batch_size is None:
+                self.static_batch_size = input_.shape[0]
+            elif input_.shape[0] != self.static_batch_size:
+                return self.forward_loss(input_, label[0], label[1], reduction)
+        return self.compiled(input_, label[0], label[1], reduction)
+
+
+def loss_step_setup(model, detection_loss, params):
+    """
+    the compiled step if params.compile is set, None for the eager train step
+    """
+    if not params.compile:
+        return None
+    print("Compiling the forward + loss step, dynamic batch size: ", bool(params.compile_dynamic))
+    return Loss_Step(model, detection_loss, params)
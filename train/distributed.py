@@ -0,0 +1,213 @@
+import math
+import contextlib
+import torch
+import torch.distributed as dist
+from torch.utils.data.sampler import Sampler
+from torch.nn.parallel import DistributedDataParallel
+
+from general_config import general_config
+
+"""
+Helpers for multi process (and multi node) data parallel training on top of torch.distributed
+
+Launch one process per device, eg on a single CPU-only machine:
+    torchrun --nproc_per_node=4 -m main
+The rendezvous is read from the usual env variables (MASTER_ADDR, MASTER_PORT, RANK, WORLD_SIZE),
+so torchrun / torch.distributed.launch can also be used across nodes.
+
+The repo pins everything to general_config.device, so when training on GPUs each process
+should only see its own device (eg CUDA_VISIBLE_DEVICES=$LOCAL_RANK)
+"""
+
+
+def init_distributed(backend=None):
+    """
+    joins the process group described by the environment, returns the rank of this process
+    """
+    if is_distributed():
+        return get_rank()
+
+    backend = backend or general_config.dist_backend
+    dist.init_process_group(backend=backend, init_method="env://")
+    print("Initialized process group: rank {} of {} ({})".format(
+        get_rank(), get_world_size(), backend))
+    return get_rank()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, params):
+    """
+    wraps the model in DistributedDataParallel, gradients are all-reduced during backward
+    frozen backbone layers do not produce gradients, so DDP has to look for unused parameters
+    """
+    if not is_distributed():
+        return model
+    device_ids = [general_config.device] if general_config.device.type == "cuda" else None
+    return DistributedDataParallel(model, device_ids=device_ids,
+                                   find_unused_parameters=bool(params.freeze_backbone))
+
+
+def sync_gradients(model, sync=True):
+    """
+    context in which the backward pass all-reduces the gradients only if sync is True
+    used to skip the communication for all but the last micro batch of a gradient accumulation step
+    """
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def unwrap_model(model):
+    """
+    returns the underlying module of a DistributedDataParallel model
+    """
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def reduce_losses(losses, n_samples, indices=(2, 3)):
+    """
+    sums the given loss accumulators (see utils.training.update_losses) and the number of samples
+    they were accumulated over across all processes, the losses in place
+    returns the total number of samples, to normalize the losses by: the validation shards are not
+    padded, so they can have different sizes
+    """
+    if not is_distributed():
+        return n_samples
+    tensor = torch.tensor([losses[i] for i in indices] + [n_samples], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    reduced = tensor.tolist()
+    for i, value in zip(indices, reduced):
+        losses[i] = value
+    return int(reduced[-1])
+
+
+def gather_detections(prediction_annotations):
+    """
+    collects the COCO formatted detections of every process, ids are renumbered to stay unique
+    """
+    if not is_distributed():
+        return prediction_annotations
+
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, prediction_annotations)
+
+    all_annotations = []
+    for annotations in gathered:
+        for annotation in annotations:
+            annotation["id"] = len(all_annotations) + 1
+            all_annotations.append(annotation)
+    return all_annotations
+
+
+def broadcast_value(value, src=0):
+    """
+    sends a python number from process src to all the others
+    """
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.broadcast(tensor, src=src)
+    return tensor.item()
+
+
+def set_sampler_epoch(data_loader, epoch):
+    """
+    reshuffles the distributed shards for a new epoch
+    """
+    if isinstance(data_loader.sampler, DistributedBatchSampler):
+        data_loader.sampler.set_epoch(epoch)
+
+
+class DistributedBatchSampler(Sampler):
+    """
+    Distributed counterpart of BatchSampler(SubsetRandomSampler(indices)) - yields lists of indices,
+    as expected by CocoDetection.__getitem__, each process receiving a disjoint shard of the dataset
+
+    The dataset order is a permutation seeded by (seed, epoch), identical on all processes.
+    For training it is padded to a multiple of the world size so every process runs the same
+    number of steps (needed to keep the gradient all-reduce in lockstep), for validation pad
+    should be False so that no image is evaluated twice
+    """
+
+    def __init__(self, indices, batch_size, shuffle=True, drop_last=True,
+                 num_replicas=None, rank=None, seed=0, pad=True):
+        self.indices = list(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+
+        if self.pad:
+            self.num_samples = int(math.ceil(len(self.indices) / self.num_replicas))
+            self.total_size = self.num_samples * self.num_replicas
+        else:
+            self.num_samples = len(range(self.rank, len(self.indices), self.num_replicas))
+            self.total_size = len(self.indices)
+
+    @property
+    def sampler(self):
+        """
+        indices seen by this process in the current epoch, mirrors BatchSampler.sampler
+        """
+        return self._shard()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.indices), generator=generator).tolist()
+            indices = [self.indices[i] for i in order]
+        else:
+            indices = list(self.indices)
+
+        # pad by wrapping around so that all shards have the same size
+        while len(indices) < self.total_size:
+            indices += indices[:(self.total_size - len(indices))]
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        batch = []
+        for idx in self._shard():
+            batch.append(idx)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0 and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
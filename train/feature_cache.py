@@ -0,0 +1,169 @@
+import json
+import numpy as np
+import torch
+from pathlib import Path
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+
+from general_config import general_config, anchor_config
+from train import accumulation
+
+"""
+Cache of the frozen backbone outputs, used to fine-tune only the heads of SSD_Head
+(loc, conf and additional_blocks) without recomputing MobileNetV2 every epoch
+
+The backbone is run once, in eval mode, over the non-augmented train set. Its two feature maps
+(inter_layer, x) are written to memory mapped .npy files (fp16 by default, halving the disk
+size and the read bandwidth) together with the matched ground truth of each image.
+For a 300x300 input one image takes 576x19x19 + 1280x10x10 values, ~660 KB in fp16, so
+this is meant for subsets such as the one of ssdlite_1_class rather than the whole of COCO.
+"""
+
+FILES = ("inter_layer", "x", "gt_bbox", "gt_class", "image_id", "image_size")
+
+
+def label_config(params):
+    """
+    settings the cached ground truth depends on: the anchors of the model and the IOU above which
+    an anchor is matched to an object
+    """
+    return {'anchors': anchor_config.model_to_anchors[general_config.model_id],
+            'mapping_threshold': params.mapping_threshold}
+
+
+def backbone_fingerprint(model):
+    """
+    cheap checksum of the backbone weights, a cache built with other weights is stale
+    """
+    with torch.no_grad():
+        return float(sum(p.double().abs().sum().item() for p in model.backbone.parameters()))
+
+
+class Feature_Cache():
+    """
+    Memory mapped store of (inter_layer, x, gt_bbox, gt_class, image_info) per image
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.meta_path = self.path / 'meta.json'
+
+    def file(self, name):
+        return self.path / (name + '.npy')
+
+    def meta(self):
+        if not self.meta_path.exists():
+            return None
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def is_valid(self, model, params):
+        """
+        the cache exists, is complete and was built with the current backbone weights, input size,
+        anchors and mapping threshold (the cached labels are matched to the anchors)
+        """
+        meta = self.meta()
+        return meta is not None and \
+            meta['fingerprint'] == backbone_fingerprint(model) and \
+            meta['input_size'] == [params.input_height, params.input_width] and \
+            meta['fp16'] == bool(params.cache_fp16) and \
+            meta.get('labels') == json.loads(json.dumps(label_config(params)))
+
+    def build(self, model, data_loader, params):
+        """
+        runs the backbone once over data_loader, which should not augment its images
+        the number of images is only known at the end (images without annotations are dropped
+        by the dataset), so the files are allocated for the whole sampler and trimmed in the meta
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self.meta_path.exists():
+            self.meta_path.unlink()
+
+        feature_dtype = np.float16 if params.cache_fp16 else np.float32
+        capacity = len(data_loader.sampler.sampler)
+        device = general_config.device
+        model.eval()
+
+        stores, count = None, 0
+        with torch.no_grad():
+            for batch_idx, (input_, label, image_info) in enumerate(data_loader):
+                inter_layer, x = model.backbone(input_.to(device))
+                batch = {
+                    'inter_layer': inter_layer.cpu().numpy().astype(feature_dtype),
+                    'x': x.cpu().numpy().astype(feature_dtype),
+                    'gt_bbox': label[0].numpy().astype(np.float32),
+                    'gt_class': label[1].numpy(),
+                    'image_id': np.array([info[0] for info in image_info], dtype=np.int64),
+                    'image_size': np.array([info[1] for info in image_info], dtype=np.int64),
+                }
+                if stores is None:
+                    stores = {name: np.lib.format.open_memmap(
+                        self.file(name), mode='w+', dtype=value.dtype,
+                        shape=(capacity, *value.shape[1:])) for name, value in batch.items()}
+
+                n_images = batch['x'].shape[0]
+                for name, value in batch.items():
+                    stores[name][count:count + n_images] = value
+                count += n_images
+
+                if (batch_idx + 1) % max(len(data_loader) // general_config.batch_stats_step, 1) == 0:
+                    print('Cached features of {} images'.format(count))
+
+        if stores is None:
+            raise ValueError("No images to cache, the data loader is empty")
+        for store in stores.values():
+            store.flush()
+        del stores
+
+        # the meta is written last, a cache without it is incomplete
+        with open(self.meta_path, 'w') as f:
+            json.dump({'count': count,
+                       'fingerprint': backbone_fingerprint(model),
+                       'input_size': [params.input_height, params.input_width],
+                       'fp16': bool(params.cache_fp16),
+                       'labels': label_config(params)}, f)
+        print('Feature cache built: {} images in {}'.format(count, self.path))
+
+    def load(self):
+        """
+        returns the read only memory maps of all the files and the number of cached images
+        """
+        meta = self.meta()
+        if meta is None:
+            raise FileNotFoundError('No complete feature cache in {}'.format(self.path))
+        stores = {name: np.load(self.file(name), mmap_mode='r') for name in FILES}
+        return stores, meta['count']
+
+
+class Cached_Features(Dataset):
+    """
+    Dataset over a Feature_Cache, with the same batched contract as CocoDetection:
+    __getitem__ takes a list of indices and returns ((inter_layer, x), label, image_info)
+    """
+
+    def __init__(self, feature_cache):
+        self.stores, self.count = feature_cache.load()
+
+    def __getitem__(self, batched_indices):
+        # sorted indices keep the memory map reads mostly sequential
+        indices = np.sort(np.asarray(batched_indices))
+
+        def read(name):
+            return torch.from_numpy(np.ascontiguousarray(self.stores[name][indices]))
+
+        features = (read('inter_layer').float(), read('x').float())
+        label = (read('gt_bbox'), read('gt_class'))
+        image_info = [(int(img_id), tuple(size)) for img_id, size in
+                      zip(self.stores['image_id'][indices], self.stores['image_size'][indices].tolist())]
+        return features, label, image_info
+
+    def __len__(self):
+        return self.count
+
+
+def get_cached_dataloader(feature_cache, params):
+    dataset = Cached_Features(feature_cache)
+    return DataLoader(dataset, batch_size=None,
+                      shuffle=False, num_workers=general_config.num_workers,
+                      sampler=BatchSampler(SubsetRandomSampler([i for i in range(len(dataset))]),
+                                           batch_size=accumulation.loader_batch_size(params), drop_last=True))
@@ -1,12 +1,12 @@
 import torch
 import math
 from torch import nn
-import copy
 
 from general_config.general_config import device
 from general_config.anchor_config import default_boxes
 from general_config import constants
 from utils.preprocessing import map_id_to_idx
+from utils.box_computations import to_anchor_major
 
 # inspired by fastai http://course18.fast.ai/lessons/lesson9.html course
 
@@ -16,11 +16,13 @@ class Classification_Loss(nn.Module):
         super().__init__()
         self.loss_type = params.loss_type
         self.focal_loss = params.use_focal_loss
+        self.anchor_major = params.anchor_major
 
     def forward(self, pred, targ):
         """
         Arguments:
-            pred - tensor of shape batch x n_classes x anchors
+            pred - tensor of shape batch x anchors x n_classes
+            (contiguous if the model outputs are anchor major, a permuted view otherwise)
             targ - tensor of shape batch x anchors
 
         Explanation:
@@ -30,11 +32,10 @@ class Classification_Loss(nn.Module):
             for softmax it is just a list of indeces
         Returns: softmax loss or (weighted if focal) BCE loss
         """
-        batch, n_classes, n_anchors = pred.shape
+        batch, n_anchors, n_classes = pred.shape
         class_idx = map_id_to_idx(targ)
 
         if self.loss_type == constants.BCE_loss:
-            pred = pred.permute(0, 2, 1).contiguous()
             one_hot = torch.nn.functional.one_hot(class_idx, num_classes=n_classes+1).float()
             one_hot = one_hot.to(device)
 
@@ -46,8 +47,12 @@ class Classification_Loss(nn.Module):
                                                                             weight=weight,
                                                                             reduction='none')
             return bce_loss.sum(dim=2)
+        elif self.anchor_major:
+            return torch.nn.functional.cross_entropy(pred.view(-1, n_classes), class_idx.view(-1),
+                                                     reduction='none').view(batch, n_anchors)
         else:
-            return torch.nn.functional.cross_entropy(pred, class_idx, reduction='none')
+            # back to the contiguous batch x n_classes x anchors model output
+            return torch.nn.functional.cross_entropy(pred.permute(0, 2, 1), class_idx, reduction='none')
 
     def get_weight(self, x, t):
         # focal loss decreases loss for correctly classified (P>0.5) examples, relative to the missclassified ones
@@ -95,19 +100,22 @@ class Detection_Loss():
 
         self.anchors_batch = self.anchors_xywh.unsqueeze(dim=0).to(device)
 
-    def ssd_loss(self, pred, targ):
+    def ssd_loss(self, pred, targ, reduction='mean'):
         """
         Arguments:
             pred - model output - two tensors of dim B x 4 x #anchors and B x n_classes x #anchors in a list
+            (B x #anchors x 4 and B x #anchors x n_classes if params.anchor_major)
             targ - ground truth - two tensors of dim B x #anchors x 4 and B x #anchors in a list
+            reduction - 'mean' or 'sum' over the images of the batch
 
         Explanation:
         each image loss is normalized by the number of anchors to obj mappings
-        total loss is normalized by the batch size
+        total loss is normalized by the batch size, unless reduction is 'sum' (used for gradient
+        accumulation, where the normalization is done by the images of the whole step)
 
         Return: loc and class loss per whole batch
         """
-        pred_bbox, pred_id = pred[0].permute(0, 2, 1), pred[1]
+        pred_bbox, pred_id = to_anchor_major(pred, self.params)
         gt_bbox, gt_id = targ
 
         # compute offsets
@@ -123,15 +131,17 @@ class Detection_Loss():
 
         # normalize by mappings per each image in the batch then take the mean
         # we skip images without annotations, so no element in pos_num is 0
-        localization_loss = (localization_loss / pos_num.float()).mean(dim=0)
-        classification_loss = (classification_loss / pos_num.float()).mean(dim=0)
-        return localization_loss, classification_loss
+        localization_loss = localization_loss / pos_num.float()
+        classification_loss = classification_loss / pos_num.float()
+        if reduction == 'sum':
+            return localization_loss.sum(dim=0), classification_loss.sum(dim=0)
+        return localization_loss.mean(dim=0), classification_loss.mean(dim=0)
 
     def hard_negative_mining(self, pos_mask, pos_num, losses, ids_for_anchors, ratio=3):
         """
         Taken from https://github.com/NVIDIA/DeepLearningExamples/tree/master/PyTorch/Detection/SSD
         """
-        losses_ = copy.deepcopy(losses.detach())
+        losses_ = losses.detach().clone()
         losses_[pos_mask] = -math.inf
         _, indexes = losses_.sort(dim=1, descending=True)
         _, orders = indexes.sort(dim=1)
@@ -160,7 +170,7 @@ class Detection_Loss():
         Arguments:
         pos_mask - indeces of matched anchors
         pos_num - how many mappings for each image
-        pred_id - [batch x n_classes x #anchors] tensor - confidence scores by each anchor
+        pred_id - [batch x #anchors x n_classes] tensor - confidence scores by each anchor
         gt_id - [batch x #anchors x 1] tensor - ground truth class ids
 
         returns: softmax/BCE between predicted scores and gt for each image in batch
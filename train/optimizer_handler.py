@@ -1,33 +1,56 @@
+import inspect
+import itertools
 import torch.optim as optim
 
+from general_config import general_config
+
 """
 Various optimizer setups
 """
 
 
+def multi_tensor_options(optimizer_class):
+    """
+    foreach/fused implementations update all the tensors of a param group with a few kernels,
+    instead of a python loop over each tensor - use them if this torch version has them
+    fused kernels are only used on gpu
+    """
+    signature = inspect.signature(optimizer_class.__init__).parameters
+    if 'fused' in signature and general_config.device.type == 'cuda':
+        return {'fused': True}
+    if 'foreach' in signature:
+        return {'foreach': True}
+    return {}
+
+
+def head_parameters(model):
+    return itertools.chain(model.loc.parameters(), model.conf.parameters(),
+                           model.additional_blocks.parameters())
+
+
 def layer_specific_adam(model, params):
     print("AMS grad is false")
     return optim.Adam([
         {'params': model.backbone.parameters(), 'lr': params.learning_rate * params.decay_rate},
-        {'params': model.loc.parameters()},
-        {'params': model.conf.parameters()},
-        {'params': model.additional_blocks.parameters()}
-    ], lr=params.learning_rate, weight_decay=params.weight_decay, amsgrad=False)
+        {'params': head_parameters(model)}
+    ], lr=params.learning_rate, weight_decay=params.weight_decay, amsgrad=False,
+        **multi_tensor_options(optim.Adam))
 
 
 def layer_specific_sgd(model, params):
     return optim.SGD([
         {'params': model.backbone.parameters(), 'lr': params.learning_rate * params.decay_rate},
-        {'params': model.loc.parameters()},
-        {'params': model.conf.parameters()},
-        {'params': model.additional_blocks.parameters()}
-    ], lr=params.learning_rate, weight_decay=params.weight_decay, momentum=0.9)
+        {'params': head_parameters(model)}
+    ], lr=params.learning_rate, weight_decay=params.weight_decay, momentum=0.9,
+        **multi_tensor_options(optim.SGD))
 
 
 def plain_adam(model, params):
-    return optim.Adam(model.parameters(), lr=params.learning_rate, weight_decay=params.weight_decay)
+    return optim.Adam(model.parameters(), lr=params.learning_rate, weight_decay=params.weight_decay,
+                      **multi_tensor_options(optim.Adam))
 
 
 def plain_sgd(model, params):
     return optim.SGD(model.parameters(), lr=params.learning_rate,
-                     weight_decay=params.weight_decay, momentum=0.9)
+                     weight_decay=params.weight_decay, momentum=0.9,
+                     **multi_tensor_options(optim.SGD))
@@ -1,4 +1,6 @@
 from train.backbone_freezer import Backbone_Freezer
+from train import distributed, accumulation, compiled_step
+from architectures import quantization
 from utils.prints import print_train_batch_stats, print_train_stats
 from general_config.general_config import device
 from utils.training import update_losses, update_tensorboard_graphs
@@ -12,14 +14,45 @@ except ImportError:
     raise ImportError("Please install APEX from https://github.com/nvidia/apex")
 
 
-def train_step(model, input_, label, optimizer, losses, detection_loss, params, use_amp=False):
-    input_ = input_.to(device)
-    label[0] = label[0].to(device)
-    label[1] = label[1].to(device)
-    optimizer.zero_grad()
-    output = model(input_)
+def model_forward(model, input_):
+    return model(input_)
+
+
+def cached_forward(model, input_):
+    """
+    batches of train.feature_cache: the two backbone feature maps, only the heads are run
+    """
+    inter_layer, x = input_
+    return distributed.unwrap_model(model).head_forward(inter_layer, x)
 
-    l_loss, c_loss = detection_loss.ssd_loss(output, label)
+
+def input_to_device(input_):
+    if isinstance(input_, (tuple, list)):
+        return tuple(tensor.to(device) for tensor in input_)
+    return input_.to(device)
+
+
+def input_size(input_):
+    """
+    number of images of a batch of images or of cached features
+    """
+    return input_[0].shape[0] if isinstance(input_, (tuple, list)) else input_.shape[0]
+
+
+def train_step(model, input_, label, optimizer, losses, detection_loss, params, use_amp=False,
+               loss_step=None, forward=model_forward):
+    """
+    loss_step - compiled forward + loss, see train/compiled_step.py, eager if None
+    forward - model_forward, or cached_forward for the batches of the feature cache
+    """
+    input_ = input_to_device(input_)
+    label = [label[0].to(device), label[1].to(device)]
+    optimizer.zero_grad()
+    if loss_step is not None:
+        l_loss, c_loss = loss_step(input_, label)
+    else:
+        output = forward(model, input_)
+        l_loss, c_loss = detection_loss.ssd_loss(output, label)
     loss = l_loss + c_loss
 
     update_losses(losses, l_loss.item(), c_loss.item())
@@ -33,8 +66,47 @@ def train_step(model, input_, label, optimizer, losses, detection_loss, params,
     optimizer.step()
 
 
+def accumulation_train_step(model, micro_batches, optimizer, losses, detection_loss, params,
+                            use_amp=False, loss_step=None, forward=model_forward):
+    """
+    one optimizer step over a list of micro batches, the gradients are accumulated such that they
+    are equal to the ones of a single batch containing all the images: each image loss is
+    normalized by the total number of images in the step (not by the micro batch size)
+    """
+    n_images = sum(input_size(input_) for input_, _, _ in micro_batches)
+    optimizer.zero_grad()
+
+    step_l_loss, step_c_loss = 0, 0
+    for idx, (input_, label, _) in enumerate(micro_batches):
+        last = idx == len(micro_batches) - 1
+        input_ = input_to_device(input_)
+        label = [label[0].to(device), label[1].to(device)]
+
+        with distributed.sync_gradients(model, sync=last):
+            if loss_step is not None:
+                l_loss, c_loss = loss_step(input_, label, reduction='sum')
+            else:
+                output = forward(model, input_)
+                l_loss, c_loss = detection_loss.ssd_loss(output, label, reduction='sum')
+            l_loss, c_loss = l_loss / n_images, c_loss / n_images
+            loss = l_loss + c_loss
+
+            if use_amp:
+                with amp.scale_loss(loss, optimizer, delay_unscale=not last) as scaled_loss:
+                    scaled_loss.backward()
+            else:
+                loss.backward()
+
+        step_l_loss += l_loss.item()
+        step_c_loss += c_loss.item()
+
+    update_losses(losses, step_l_loss, step_c_loss)
+    optimizer.step()
+
+
 def train(model, optimizer, train_loader, model_evaluator,
-          detection_loss, params, writer, lr_decay_policy, start_epoch=0, use_amp=False):
+          detection_loss, params, writer, lr_decay_policy, start_epoch=0, use_amp=False,
+          from_cache=False):
     """
     args: model - nn.Module CNN to train
           optimizer - torch.optim
@@ -43,43 +115,83 @@ def train(model, optimizer, train_loader, model_evaluator,
           detection_loss - class used to handle loss
           params - json config
           writer - tensorboard writer - logs losses and mAP
+          from_cache - the batches of train_loader are the backbone outputs stored by
+          train.feature_cache.Feature_Cache, only the heads are run and trained, the backbone
+          stays frozen (validation still runs the whole model on the validation images)
     trains model, saves best model by validation
     """
 
     backbone_freezer = Backbone_Freezer(params)
+    forward = cached_forward if from_cache else model_forward
+    if from_cache and (params.compile or params.qat_epochs):
+        raise ValueError("The compiled step and quantization aware training need the whole model, "
+                         "they do not work from the feature cache")
     losses = [0] * 4
 
-    if params.freeze_backbone:
-        backbone_freezer.freeze_backbone(model)
+    # with gradient accumulation one step is made of several loader batches
+    n_accumulation = accumulation.accumulation_steps(params)
+    steps_per_epoch = accumulation.steps_per_epoch(train_loader, params)
+
+    if params.qat_epochs and use_amp:
+        raise ValueError("Quantization aware training does not work with mixed precision")
+    qat_active = False
+
+    if params.compile and use_amp:
+        raise ValueError("The compiled train step does not work with apex mixed precision")
+    loss_step = compiled_step.loss_step_setup(model, detection_loss, params)
+
+    # the freezer works on the actual model, not on its DistributedDataParallel wrapper
+    if params.freeze_backbone or from_cache:
+        backbone_freezer.freeze_backbone(distributed.unwrap_model(model))
 
     print(datetime.datetime.now())
     for epoch in range(start_epoch, params.n_epochs):
         model.train()
+        distributed.set_sampler_epoch(train_loader, epoch)
+        qat_active = quantization.qat_step(epoch, distributed.unwrap_model(model), params)
 
-        if general_config.model_id == constants.ssdlite:
-            backbone_freezer.step(epoch, model)
+        # the cached features are the ones of the frozen backbone
+        if general_config.model_id == constants.ssdlite and not from_cache:
+            backbone_freezer.step(epoch, distributed.unwrap_model(model))
         print("Total number of parameters trained this epoch: ",
               sum(p.numel() for pg in optimizer.param_groups for p in pg['params'] if p.requires_grad))
 
-        for batch_idx, (input_, label, _) in enumerate(train_loader):
+        for batch_idx, micro_batches in enumerate(accumulation.accumulation_groups(train_loader,
+                                                                                  n_accumulation)):
             if epoch == 0 and params.warm_up:
-                lr_decay_policy.warm_up(batch_idx, len(train_loader))
+                lr_decay_policy.warm_up(batch_idx, steps_per_epoch)
             else:
                 lr_decay_policy.step(epoch)
 
-            train_step(model, input_, label, optimizer, losses, detection_loss, params, use_amp)
+            if n_accumulation == 1:
+                input_, label, _ = micro_batches[0]
+                train_step(model, input_, label, optimizer, losses, detection_loss, params, use_amp,
+                           loss_step, forward)
+            else:
+                accumulation_train_step(model, micro_batches, optimizer, losses, detection_loss,
+                                        params, use_amp, loss_step, forward)
 
-            print_train_batch_stats(model=model, epoch=epoch, batch_idx=batch_idx,
-                                    data_loader=train_loader,
-                                    losses=losses, optimizer=optimizer, params=params)
+            if distributed.is_main_process():
+                print_train_batch_stats(model=model, epoch=epoch, batch_idx=batch_idx,
+                                        data_loader=train_loader,
+                                        losses=losses, optimizer=optimizer, params=params,
+                                        n_batches=steps_per_epoch)
 
         if (epoch + 1) % general_config.eval_step == 0:
             mAP, loc_loss_val, class_loss_val = model_evaluator.complete_evaluate(model, optimizer,
                                                                                   epoch)
+            n_samples = distributed.reduce_losses(losses, len(train_loader.sampler.sampler))
             loc_loss_train, class_loss_train = print_train_stats(
-                train_loader, losses, params)
-            update_tensorboard_graphs(writer, loc_loss_train, class_loss_train,
-                                      loc_loss_val, class_loss_val, mAP, epoch)
+                train_loader, losses, params, n_samples)
+            if distributed.is_main_process():
+                update_tensorboard_graphs(writer, loc_loss_train, class_loss_train,
+                                          loc_loss_val, class_loss_val, mAP, epoch)
             losses[2], losses[3] = 0, 0
 
         losses[0], losses[1] = 0, 0
+
+    if qat_active and distributed.is_main_process():
+        quantized_model = quantization.convert_qat_model(distributed.unwrap_model(model))
+        quantization.save_quantized(quantized_model, params,
+                                    constants.quantized_model_path.format(general_config.model_id))
+
@@ -4,6 +4,7 @@ import datetime
 from misc.model_output_handler import Model_output_handler
 from utils import postprocessing, training, prints
 from general_config.general_config import device
+from train import distributed
 
 
 class Model_evaluator():
@@ -30,6 +31,8 @@ class Model_evaluator():
         also logs info to tensorboard
         """
         print('Validation start...')
+        # each process evaluates its own shard, no need to go through DistributedDataParallel
+        model = distributed.unwrap_model(model)
         model.eval()
         with torch.no_grad():
             losses = [0] * 4
@@ -54,7 +57,9 @@ class Model_evaluator():
                 prints.print_val_batch_stats(
                     model, batch_idx, self.valid_loader, losses, self.params)
 
-            mAP = postprocessing.evaluate_on_COCO_metrics(prediction_annotations)
+            mAP = self.evaluate_detections(prediction_annotations)
+            # summed over the shards of all processes
+            val_set_size = distributed.reduce_losses(losses, val_set_size)
 
             val_loss = (losses[2] + losses[3]) / val_set_size
             if self.stats.mAP < mAP:
@@ -73,10 +78,12 @@ class Model_evaluator():
 
         print('Validation finished')
 
-    def only_mAP(self, model):
+    def only_mAP(self, model, device=device):
         """
         only computes the mAP (for cross validation)
+        device - where model runs, eg cpu for a quantized model
         """
+        model = distributed.unwrap_model(model)
         model.eval()
         with torch.no_grad():
             prediction_annotations = []
@@ -91,4 +98,15 @@ class Model_evaluator():
                 prediction_annotations, prediction_id = postprocessing.prepare_outputs_for_COCOeval(
                     output, image_info, prediction_annotations, prediction_id, self.output_handler)
             # map
-            return postprocessing.evaluate_on_COCO_metrics(prediction_annotations)
+            return self.evaluate_detections(prediction_annotations)
+
+    def evaluate_detections(self, prediction_annotations):
+        """
+        computes the mAP over the detections of all processes, COCO evaluation only runs on the
+        first one and its result is shared with the others
+        """
+        prediction_annotations = distributed.gather_detections(prediction_annotations)
+        mAP = 0
+        if distributed.is_main_process():
+            mAP = postprocessing.evaluate_on_COCO_metrics(prediction_annotations)
+        return distributed.broadcast_value(mAP)
@@ -2,6 +2,17 @@ import torch
 import numpy as np
 
 
+def to_anchor_major(output, params):
+    """
+    model outputs as B x #anchors x 4 and B x #anchors x n_classes, whatever params.anchor_major is
+    the class major layout is only permuted as a view, the anchor major one is returned as is
+    """
+    locs, confs = output
+    if params.anchor_major:
+        return locs, confs
+    return locs.permute(0, 2, 1), confs.permute(0, 2, 1)
+
+
 def wh2corners_numpy(ctr, wh):
     return np.concatenate([ctr-wh/2, ctr+wh/2], axis=1)
 
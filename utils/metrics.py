@@ -0,0 +1,195 @@
+import time
+import threading
+from contextlib import contextmanager
+
+"""
+Minimal Prometheus metrics (text exposition format 0.0.4), without the client library
+
+Counters, gauges and histograms with labels, thread safe, rendered by REGISTRY.render() for the
+/metrics endpoints of run_flask.py and run_asgi.py. Stage_Timer times named stages with
+time.perf_counter, it is used by the servers (into the STAGE_LATENCY histogram, and per request
+for the time_taken of /process_images) and by Speed_testing (the totals are summed per stage)
+
+Served stages: upload_read, decode, preprocess (resize + normalize), forward, threshold
+(box decoding + confidence threshold), nms, serialization
+"""
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric():
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("{} expects the labels {}, got {}".format(
+                self.name, self.label_names, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.metric_type)]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return ['{}{} {}'.format(self.name, _format_labels(self.label_names, key), _format_value(value))
+                for key, value in values]
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        """
+        the value is read from function() when rendered, for unlabeled gauges (e.g. a queue size)
+        """
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return ['{} {}'.format(self.name, _format_value(self.function()))]
+        return super().samples()
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.label_names, key, [('le', _format_value(bound))]),
+                    cumulative))
+            labels = _format_labels(self.label_names, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Stage_Timer():
+    """
+    with timer.stage('forward'): ...
+    the durations are observed in histogram (labeled by stage), if given, and summed in totals
+    """
+
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=stage)
+        with self.lock:
+            self.totals[stage] = self.totals.get(stage, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = Registry()
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    'detector_stage_seconds', 'Latency of each request processing stage', ['stage']))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'detector_batch_size', 'Images per forward pass of the batching engine', buckets=BATCH_SIZE_BUCKETS))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'detector_queue_depth', 'Requests waiting in the batching engine queue'))
+REQUESTS = REGISTRY.register(Counter(
+    'detector_requests_total', 'Served requests by endpoint and status code', ['endpoint', 'code']))
+REJECTED = REGISTRY.register(Counter(
+    'detector_rejected_total', 'Requests rejected or dropped by the admission control', ['reason']))
+CACHE_EVENTS = REGISTRY.register(Counter(
+    'detector_cache_events_total', 'Result cache lookups and evictions by event', ['event']))
+MODEL_INFO = REGISTRY.register(Gauge(
+    'detector_model_info', 'Served model', ['model_id', 'device', 'backend']))
+
+# the server side stage timer, the totals are not used
+server_timer = Stage_Timer(STAGE_LATENCY)
+timed = server_timer.stage
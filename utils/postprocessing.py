@@ -3,7 +3,7 @@ import cv2
 
 import json
 from general_config import classes_config, constants, general_config
-from utils.box_computations import get_IoU
+from utils.box_computations import get_IoU, to_anchor_major
 
 
 from pycocotools.cocoeval import COCOeval
@@ -119,14 +119,12 @@ def prepare_outputs_for_COCOeval(output, image_info, prediction_annotations, pre
     convert raw model outputs to format required by COCO evaluation
     """
     batch_size = output[0].shape[0]
+    pred_bbox, pred_class = to_anchor_major(output, output_handler.params)
 
     for i in range(batch_size):
 
         image_id = image_info[i][0]
 
-        pred_bbox = output[0].permute(0, 2, 1)
-        pred_class = output[1].permute(0, 2, 1)
-
         complete_outputs = output_handler.process_outputs(
             pred_bbox[i], pred_class[i], image_info[i])
 
@@ -160,13 +158,15 @@ def evaluate_on_COCO_metrics(prediction_annotations):
     return cocoevalu.stats[0]
 
 
-def postprocess_until_nms(output_handler, pred_boxes, pred_confs, img_size=(300, 300)):
+def postprocess_until_nms(output_handler, pred_boxes, pred_confs, img_size=(300, 300),
+                          conf_threshold=None):
     """
     Processes immediate model outputs to get data for nms
 
     Args:
     pred_boxes: #anchors x 4 tensor scaled in range [0,1]
     pred_confs: #anchors x n_classes tensor of confidences
+    conf_threshold: defaults to the confidence_threshold of output_handler
 
     Returns:
     ndarrays
@@ -177,7 +177,7 @@ def postprocess_until_nms(output_handler, pred_boxes, pred_confs, img_size=(300,
 
     # cut predictions that are below confidence threshold
     pred_boxes, pred_confs = output_handler._predictions_over_threshold(pred_boxes,
-                                                                        pred_confs)
+                                                                        pred_confs, conf_threshold)
 
     # get predicted classes and respective confidences
     pred_classes, highest_confidence_for_predictions = output_handler._get_predicted_class(
@@ -170,13 +170,22 @@ def get_bboxes(coco_annotation):
     return gt_bboxes, gt_classes
 
 
+# id -> idx lookup table of each device, unknown ids map to 0
+_id2idx_tables = {}
+
+
 def map_id_to_idx(class_ids):
     """
-    maps the tensor of class ids to indeces
+    maps the tensor of class ids to indeces, with a single gather in a lookup table
+    ids that are not in classes_config.training_ids2_idx map to 0 (background)
     """
-    class_idx = torch.zeros(class_ids.shape, dtype=int)
-    for k, v in classes_config.training_ids2_idx.items():
-        class_idx[class_ids == k] = v
-
-    class_idx = class_idx.to(device)
-    return class_idx
+    class_ids = class_ids.to(device).long()
+    if class_ids.device not in _id2idx_tables:
+        table = torch.zeros(max(classes_config.training_ids2_idx) + 1, dtype=torch.long)
+        for k, v in classes_config.training_ids2_idx.items():
+            table[k] = v
+        _id2idx_tables[class_ids.device] = table.to(class_ids.device)
+    table = _id2idx_tables[class_ids.device]
+    # ids outside the table are clamped for the gather, then masked to 0
+    in_table = (class_ids >= 0) & (class_ids < len(table))
+    return table[class_ids.clamp(0, len(table) - 1)] * in_table
@@ -28,7 +28,8 @@ def print_trained_parameters_count(model, optimizer):
     print("-------------------------------------------------------")
 
 
-def print_train_batch_stats(model, epoch, batch_idx, data_loader, losses, optimizer, params):
+def print_train_batch_stats(model, epoch, batch_idx, data_loader, losses, optimizer, params,
+                            n_batches=None):
     '''
     prints statistics about the recently seen batches
     the printing interval is set through general_config.batch_stats_step - which means printing
@@ -36,12 +37,16 @@ def print_train_batch_stats(model, epoch, batch_idx, data_loader, losses, optimi
 
     eg: for a dataset of 1000 images, a batch size of 10 and batch_stats_step = 10
     - a print will be made after each 10 batches (100 images)
+
+    n_batches - number of optimizer steps per epoch, if different from the loader size
+    (gradient accumulation)
     '''
-    one_nth_of_loader = len(data_loader) // general_config.batch_stats_step
+    n_batches = n_batches or len(data_loader)
+    one_nth_of_loader = max(n_batches // general_config.batch_stats_step, 1)
     if (batch_idx + 1) % one_nth_of_loader == 0:
         print(datetime.datetime.now())
         print('Epoch: {} of {}'.format(epoch, params.n_epochs))
-        print_batch_stats(batch_idx, data_loader, losses[0], losses[1], one_nth_of_loader, params)
+        print_batch_stats(batch_idx, n_batches, losses[0], losses[1], one_nth_of_loader, params)
 
         mean_grads, max_grads, mean_weights, max_weights = gradient_weight_check(model)
         print('Mean and max gradients over whole network: ', mean_grads, max_grads)
@@ -59,12 +64,12 @@ def print_train_batch_stats(model, epoch, batch_idx, data_loader, losses, optimi
 def print_val_batch_stats(model, batch_idx, data_loader, losses, params):
     one_nth_of_loader = len(data_loader) // general_config.batch_stats_step
     if (batch_idx + 1) % one_nth_of_loader == 0:
-        print_batch_stats(batch_idx, data_loader, losses[0], losses[1], one_nth_of_loader, params)
+        print_batch_stats(batch_idx, len(data_loader), losses[0], losses[1], one_nth_of_loader, params)
         losses[0], losses[1] = 0, 0
 
 
-def print_batch_stats(batch_idx, data_loader, loc_loss, class_loss, one_nth_of_loader, params):
-    print('Batch: {} of {}'.format(batch_idx, len(data_loader)))
+def print_batch_stats(batch_idx, n_batches, loc_loss, class_loss, one_nth_of_loader, params):
+    print('Batch: {} of {}'.format(batch_idx, n_batches))
 
     avg_factor = one_nth_of_loader * params.batch_size
     print('Loss in the past {} samples: Localization {} Classification {}'.format(
@@ -82,11 +87,13 @@ def print_dataset_stats(train_loader=None, valid_loader=None):
     print("-------------------------------------------------------")
 
 
-def print_train_stats(train_loader, losses, params):
+def print_train_stats(train_loader, losses, params, n_samples=None):
     """
     prints all epoch losses averaged on a single sample
+    n_samples - samples per epoch the losses were summed over, defaults to the ones of train_loader
     """
-    eval_step_avg_factor = general_config.eval_step * len(train_loader.sampler.sampler)
+    n_samples = n_samples or len(train_loader.sampler.sampler)
+    eval_step_avg_factor = general_config.eval_step * n_samples
     loc_loss_train, class_loss_train = losses[2] / \
         eval_step_avg_factor, losses[3] / eval_step_avg_factor
 
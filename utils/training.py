@@ -1,9 +1,11 @@
+import copy
 import torch
 
 from data import dataloaders
 
 from architectures.models import SSDLite, resnet_ssd
-from train import optimizer_handler
+from train import optimizer_handler, distributed
+from architectures import quantization, fusion
 from general_config import constants, anchor_config, classes_config, general_config
 from train.lr_policies import poly_lr, retina_decay
 
@@ -38,23 +40,48 @@ def gradient_weight_check(model):
     return torch.mean(avg_grads), torch.mean(max_grads), torch.mean(avg_weigths), torch.mean(max_weigths)
 
 
-def model_setup(params):
+def model_setup(params, model_id=None):
     """
     creates model and moves it on to cpu/gpu
+    model_id - defaults to general_config.model_id
     """
-    n_classes = len(classes_config.training_ids)
-    if general_config.model_id == constants.ssdlite:
-        model = SSDLite.SSD_Head(n_classes=n_classes, k_list=anchor_config.k_list)
-    elif general_config.model_id == constants.ssd:
-        model = resnet_ssd.SSD300(n_classes=n_classes)
-    elif general_config.model_id == constants.ssd_modified:
-        model = SSDLite.SSD_Head(n_classes=n_classes, k_list=anchor_config.k_list,
-                                 out_channels=params.out_channels, width_mult=params.width_mult)
+    model_id = model_id or general_config.model_id
+    n_classes = len(classes_config.model_to_ids[model_id])
+    k_list = anchor_config.get_k_list(model_id)
+    anchor_major = bool(params.anchor_major)
+    if model_id == constants.ssdlite:
+        model = SSDLite.SSD_Head(n_classes=n_classes, k_list=k_list, anchor_major=anchor_major)
+    elif model_id == constants.ssd:
+        model = resnet_ssd.SSD300(n_classes=n_classes, anchor_major=anchor_major)
+    elif model_id == constants.ssd_modified:
+        model = SSDLite.SSD_Head(n_classes=n_classes, k_list=k_list,
+                                 out_channels=params.out_channels, width_mult=params.width_mult,
+                                 anchor_major=anchor_major)
     model.to(general_config.device)
 
     return model
 
 
+def inference_model_setup(params, model_id=None, fuse=True, fuse_heads=False):
+    """
+    creates the model with its trained weights, ready for inference: in eval mode and, if fuse,
+    with the batch norms folded into the convolutions (checked against the unfused model)
+    fuse_heads - also merge the loc and conf heads of each feature map, for eager torch only
+    (the ONNX exporters do not handle the writes into the preallocated outputs)
+    """
+    model = model_setup(params, model_id)
+    model = load_weigths_only(model, params, model_id)
+    model.eval()
+    if fuse or fuse_heads:
+        fused_model = fusion.fuse_for_inference(model) if fuse else copy.deepcopy(model)
+        if fuse_heads:
+            fusion.fuse_heads(fused_model)
+        differences = fusion.check_fusion(model, fused_model, params, general_config.device)
+        print("Fused model for inference, max abs output differences: ", differences)
+        model = fused_model
+    return model
+
+
 def optimizer_setup(model, params):
     """
     creates optimizer, can have layer specific options
@@ -92,15 +119,20 @@ def prepare_datasets(params):
 def load_model(model, params, optimizer):
     checkpoint = torch.load(constants.model_path.format(general_config.model_id))
     model.load_state_dict(checkpoint['model_state_dict'])
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    try:
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    except ValueError:
+        # checkpoints from before the param group merging have one group per tensor
+        print('Optimizer state has a different param group layout, starting with a fresh optimizer')
     start_epoch = checkpoint['epoch']
     print('Model loaded successfully from epoch: ', start_epoch)
 
     return model, optimizer, start_epoch
 
 
-def load_weigths_only(model, params):
-    checkpoint = torch.load(constants.model_path.format(general_config.model_id))
+def load_weigths_only(model, params, model_id=None):
+    model_id = model_id or general_config.model_id
+    checkpoint = torch.load(constants.model_path.format(model_id), map_location=general_config.device)
     model.load_state_dict(checkpoint['model_state_dict'])
     print('Weigths loaded successfully')
 
@@ -108,12 +140,19 @@ def load_weigths_only(model, params):
 
 
 def save_model(epoch, model, optimizer, params, stats, msg=None, by_loss=False):
+    # in distributed training all processes hold the same weights, only the first one saves them
+    if not distributed.is_main_process():
+        return
+
     model_path = constants.model_path
     if by_loss:
         model_path = constants.model_path_loss
+    # fake quantized weights do not load into the float model, keep them apart
+    if quantization.has_fake_quant(distributed.unwrap_model(model)):
+        model_path = constants.model_path_qat_loss if by_loss else constants.model_path_qat
     torch.save({
         'epoch': epoch + 1,
-        'model_state_dict': model.state_dict(),
+        'model_state_dict': distributed.unwrap_model(model).state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
     }, model_path.format(general_config.model_id))
     params.save(constants.params_path.format(general_config.model_id))
@@ -137,20 +176,27 @@ def update_losses(losses, l_loss, c_loss):
 def zero_wdcay_bn_bias(optimizer):
     """
     regroups optimizer param groups such that weight decay on batch norm and bias layers is 0
+
+    each param group is split in (at most) a decay and a no decay group, groups that end up with
+    the same settings are merged - the optimizer and the lr policies then loop over a handful of
+    groups instead of one group per tensor, and the multi tensor kernels see whole groups
     """
-    new_optim = []
+    new_groups = {}
     for pg in optimizer.param_groups:
+        # copy rest of attributes as they were before, the implementation is chosen again below
+        settings = {k: v for k, v in pg.items() if k not in ('params', 'foreach', 'fused')}
         for param in pg['params']:
-            new_group = {}
-            new_group['params'] = param
-            # copy rest of attributes as they were before
-            for k, v in pg.items():
-                if k != 'params':
-                    new_group[k] = v
+            param_settings = dict(settings)
             # if bias or BN
             if len(param.shape) == 1:
-                new_group['weight_decay'] = 0
-            new_optim.append(new_group)
+                param_settings['weight_decay'] = 0
+
+            key = tuple(sorted(param_settings.items()))
+            if key not in new_groups:
+                new_groups[key] = dict(param_settings, params=[])
+            new_groups[key]['params'].append(param)
 
     # construct a similar optimizer and return it
-    return torch.optim.SGD(new_optim) if type(optimizer) == torch.optim.SGD else torch.optim.Adam(new_optim)
+    optimizer_class = type(optimizer)
+    return optimizer_class(list(new_groups.values()),
+                           **optimizer_handler.multi_tensor_options(optimizer_class))